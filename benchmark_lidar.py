@@ -0,0 +1,64 @@
+import argparse
+import time
+
+import numpy as np
+
+from util.lidar import scatter, scatter_loop, point_cloud_to_xyz_image
+
+
+def synthetic_scan(n_points, H, W, seed=0):
+    rng = np.random.default_rng(seed)
+    points = rng.normal(scale=20.0, size=(n_points, 4)).astype(np.float32)
+    grid = np.stack([rng.integers(0, H, n_points), rng.integers(0, W, n_points)], axis=-1).astype(np.int32)
+    order = np.argsort(-np.linalg.norm(points[:, :3], axis=1))
+    return points, grid, order
+
+
+def synthetic_sorted_scan(n_lines, n_per_line, seed=0):
+    # counterclockwise lines from the bottom beam up, like a raw KITTI scan
+    rng = np.random.default_rng(seed)
+    lines = []
+    for i in range(n_lines):
+        yaw = np.sort(rng.uniform(0, 2 * np.pi, n_per_line))
+        pitch = np.deg2rad(-25.0 + 28.0 * i / n_lines)
+        depth = rng.uniform(2.0, 80.0, n_per_line)
+        lines.append(np.stack([depth * np.cos(pitch) * np.cos(yaw), depth * np.cos(pitch) * np.sin(yaw),
+                               depth * np.sin(pitch), rng.random(n_per_line)], axis=-1))
+    return np.concatenate(lines).astype(np.float32)
+
+
+def timeit(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def bench_scatter(args):
+    points, grid, order = synthetic_scan(args.n_points, args.height, args.width)
+    empty = lambda: np.zeros((args.height, args.width, points.shape[1]), dtype=points.dtype)
+    t_loop, ref = timeit(lambda: scatter_loop(empty(), grid[order], points[order]), args.repeat)
+    t_vec, out = timeit(lambda: scatter(empty(), grid[order], points[order]), args.repeat)
+    assert np.array_equal(ref, out), 'vectorized scatter differs from the loop'
+    print(f'scatter  {args.n_points} points -> {args.height}x{args.width}: '
+          f'loop {t_loop * 1e3:.1f} ms, vectorized {t_vec * 1e3:.1f} ms ({t_loop / t_vec:.1f}x)')
+
+
+def bench_projection(args):
+    points = synthetic_sorted_scan(64, args.n_points // 64)
+    for is_sorted in (True, False):
+        t, _ = timeit(lambda: point_cloud_to_xyz_image(points, args.height, args.width, is_sorted=is_sorted), args.repeat)
+        print(f'point_cloud_to_xyz_image is_sorted={is_sorted}: {t * 1e3:.1f} ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('micro-benchmarks of the range image projection')
+    parser.add_argument('--n_points', type=int, default=120000)
+    parser.add_argument('--height', type=int, default=64)
+    parser.add_argument('--width', type=int, default=2048)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    bench_scatter(args)
+    bench_projection(args)
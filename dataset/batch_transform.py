@@ -0,0 +1,65 @@
+import torch
+from torch.utils.data.dataloader import default_collate
+
+
+def nearest_index(in_size, out_size, device=None):
+    # same source index as F.interpolate(mode='nearest') / TF.resize(NEAREST)
+    scale = torch.tensor(in_size / out_size, dtype=torch.float32)
+    idx = (torch.arange(out_size, dtype=torch.float32) * scale).floor().long()
+    return idx.clamp_(max=in_size - 1).to(device)
+
+
+class BatchTransform():
+    """Flip, nearest resize and random crop applied once to a whole batch.
+
+    All modalities of a batch are stacked channel-wise into a single
+    (B, C, H, W) tensor. Flip, resize and crop are all pure index remaps for
+    nearest interpolation, so they are folded into one row/column index per
+    sample and applied with a single gather. The crop is taken on the index
+    vectors first, so only pixels that survive the crop are ever read.
+    Works on whatever device the batch lives on.
+    """
+
+    def __init__(self, shape, flip=False, finesize=None):
+        self.shape = tuple(shape)
+        self.flip = flip
+        self.finesize = finesize
+
+    def sample_indices(self, B, H, W, device):
+        out_h, out_w = self.shape
+        rows = nearest_index(H, out_h, device).expand(B, out_h)
+        cols = nearest_index(W, out_w, device).expand(B, out_w)
+        if self.flip:
+            flip = torch.rand(B, device=device) > 0.5
+            cols = torch.where(flip[:, None], W - 1 - cols, cols)
+        if self.finesize is not None:
+            i = torch.randint(0, out_h - self.finesize + 1, (B, 1), device=device)
+            j = torch.randint(0, out_w - self.finesize + 1, (B, 1), device=device)
+            ar = torch.arange(self.finesize, device=device)
+            rows = rows.gather(1, i + ar)
+            cols = cols.gather(1, j + ar)
+        return rows, cols
+
+    def __call__(self, batch):
+        keys = [k for k, v in batch.items() if torch.is_tensor(v)]
+        # (B, H, W[, C]) as produced by collating numpy HWC samples
+        vals = [batch[k] if batch[k].dim() == 4 else batch[k][..., None] for k in keys]
+        dtypes = [v.dtype for v in vals]
+        sizes = [v.shape[-1] for v in vals]
+        float_dtypes = [d for d in dtypes if d.is_floating_point]
+        dtype = float_dtypes[0] if float_dtypes else torch.float32
+        for d in float_dtypes[1:]:
+            dtype = torch.promote_types(dtype, d)
+        stacked = torch.cat([v.to(dtype) for v in vals], dim=-1)
+
+        B, H, W, _ = stacked.shape
+        rows, cols = self.sample_indices(B, H, W, stacked.device)
+        b = torch.arange(B, device=stacked.device)[:, None, None]
+        out = stacked[b, rows[:, :, None], cols[:, None, :]].permute(0, 3, 1, 2)
+
+        for k, v, d in zip(keys, out.split(sizes, dim=1), dtypes):
+            batch[k] = v.to(d).contiguous()
+        return batch
+
+    def collate(self, samples):
+        return self(default_collate(samples))
@@ -0,0 +1,46 @@
+import numpy as np
+from PIL import Image
+
+
+class CameraProjection():
+    """Projects LiDAR points into a camera image.
+
+    The velodyne-to-rectified-camera transform and the camera intrinsics are
+    folded into a single float32 3x4 matrix, so projecting a scan is one
+    (N, 3) x (3, 3) product instead of two float64 products on homogeneous
+    coordinates.
+    """
+
+    def __init__(self, velo_to_camera_rect, cam_intrinsic):
+        P = np.dot(cam_intrinsic, velo_to_camera_rect)[:3].astype(np.float32)
+        self.rot = np.ascontiguousarray(P[:, :3].T)
+        self.trans = P[:, 3].copy()
+
+    def pixel_coords(self, xyz, height, width):
+        """Returns (point index, row, col) of the points landing inside the image."""
+        uvz = np.dot(np.asarray(xyz[:, :3], dtype=np.float32), self.rot) + self.trans
+        z = uvz[:, 2]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            u = uvz[:, 0] / z
+            v = uvz[:, 1] / z
+        mask = (u > 0.0) & (u < width) & (v > 0.0) & (v < height) & (z > 0.0)
+        idx = np.flatnonzero(mask)
+        return idx, v[idx].astype(np.int32), u[idx].astype(np.int32)
+
+    def colorize(self, rgb_image, n_points, coords):
+        rgb = np.zeros((n_points, 3), dtype=np.int32)
+        idx, row, col = coords
+        rgb[idx] = rgb_image[row, col, :3]
+        return rgb
+
+
+def open_image(path):
+    # header only, the pixels are decoded by `image_to_pcl`
+    return Image.open(path)
+
+
+def image_to_pcl(projection, image, point_cloud):
+    """Per-point RGB of point_cloud sampled from a lazily opened image."""
+    width, height = image.size
+    coords = projection.pixel_coords(point_cloud, height, width)
+    return projection.colorize(np.asarray(image), len(point_cloud), coords)
@@ -1,15 +1,20 @@
 import os
 import os.path as osp
+import time
+import random
 import numpy as np
 import torch
 from torch.utils.data import Dataset
 from torch.utils.data import Subset
+from torch.utils.data import Sampler
+from torch.utils.data.dataloader import default_collate
 import torch.nn.functional as F
 from glob import glob
 from util.lidar import point_cloud_to_xyz_image
-from util import _map
+from util import _map, LabelMapper
 from dataset.kitti_odometry import KITTIOdometry
 from dataset.nuscene import NuScene
+from dataset.streaming import StreamingDataset, StreamingBinaryScan, streaming_cfg
 import yaml
 from util import make_class_from_dict
 
@@ -22,38 +27,86 @@ class BinaryScan(Dataset):
     self.datasetA, self.datasetB = dataset_A, dataset_B
 
   def __getitem__(self, index):
-    index_A = index % self.sizeA
-    index_B = np.random.randint(0, self.sizeB)
+    # (index_A, index_B) pairs come from UnpairedSampler
+    if isinstance(index, (tuple, list)):
+      index_A, index_B = index
+    else:
+      index_A = index % self.sizeA
+      index_B = np.random.randint(0, self.sizeB)
     return {'A': self.datasetA[index_A], 'B': self.datasetB[index_B]}
 
   def __len__(self):
     return max(self.sizeA, self.sizeB)
 
+  def collate_fn(self, samples):
+    collate_A = self.datasetA.collate_fn or default_collate
+    collate_B = self.datasetB.collate_fn or default_collate
+    return {'A': collate_A([s['A'] for s in samples]), 'B': collate_B([s['B'] for s in samples])}
+
   @staticmethod
   def map(label, mapdict):
     # put label from original values to xentropy
     # or vice-versa, depending on dictionary values
-    # make learning map a lookup table
-    maxkey = 0
-    for key, data in mapdict.items():
-      if isinstance(data, list):
-        nel = len(data)
-      else:
-        nel = 1
-      if key > maxkey:
-        maxkey = key
-    # +100 hack making lut bigger just in case there are unknown labels
-    if nel > 1:
-      lut = np.zeros((maxkey + 100, nel), dtype=np.int32)
+    return LabelMapper.get(mapdict)(label)
+
+class UnpairedSampler(Sampler):
+  """Yields (index_A, index_B) pairs for BinaryScan.
+
+  Every B frame is drawn once per pass, uniformly at random like the
+  independent randint draw it replaces, but B is visited in contiguous
+  chunks taken in shuffled order so that consecutive reads stay close on
+  disk. `interleave` chunks are read round-robin, so with interleave set to
+  the batch size every batch takes one frame from each of that many chunks
+  instead of consecutive frames of one sequence. Pairing is decided in the
+  main process from a seeded generator, so it is reproducible and
+  independent of the number of workers.
+  """
+
+  def __init__(self, dataset, shuffle=True, chunk_size=32, interleave=1, seed=0):
+    self.sizeA, self.sizeB = dataset.sizeA, dataset.sizeB
+    self.length = len(dataset)
+    self.shuffle = shuffle
+    self.chunk_size = chunk_size
+    self.interleave = max(1, interleave)
+    self.seed = seed
+    self.epoch = 0
+
+  def set_epoch(self, epoch):
+    self.epoch = epoch
+
+  def chunked_perm(self, n, g):
+    starts = (torch.randperm((n + self.chunk_size - 1) // self.chunk_size, generator=g) * self.chunk_size).tolist()
+    perm = []
+    for i in range(0, len(starts), self.interleave):
+      # position j of every chunk of the group, then position j + 1, ...
+      group = [torch.arange(s, min(s + self.chunk_size, n)) for s in starts[i:i + self.interleave]]
+      order = torch.full((len(group), self.chunk_size), -1, dtype=torch.long)
+      for k, chunk in enumerate(group):
+        order[k, :len(chunk)] = chunk
+      order = order.t().flatten()
+      perm.append(order[order >= 0])
+    return torch.cat(perm)
+
+  def __iter__(self):
+    g = torch.Generator()
+    g.manual_seed(self.seed + self.epoch)
+    self.epoch += 1
+    n_rep = lambda size: (self.length + size - 1) // size
+    if self.shuffle:
+      index_A = torch.cat([torch.randperm(self.sizeA, generator=g) for _ in range(n_rep(self.sizeA))])
     else:
-      lut = np.zeros((maxkey + 100), dtype=np.int32)
-    for key, data in mapdict.items():
-      try:
-        lut[key] = data
-      except IndexError:
-        print("Wrong key ", key)
-    # do the mapping
-    return lut[label]
+      index_A = torch.arange(self.sizeA).repeat(n_rep(self.sizeA))
+    index_B = torch.cat([self.chunked_perm(self.sizeB, g) for _ in range(n_rep(self.sizeB))])
+    return iter(zip(index_A[:self.length].tolist(), index_B[:self.length].tolist()))
+
+  def __len__(self):
+    return self.length
+
+def seed_worker(worker_id):
+  # torch seeds each worker differently, numpy inherits the parent's state
+  seed = torch.initial_seed() % 2 ** 32
+  np.random.seed(seed)
+  random.seed(seed)
 
 def get_dataset(dataset_name, cfg, ds_cfg, data_dir, split, limited_view=False, is_ref_semposs=False, norm_label=False):
   if dataset_name in ['kitti', 'carla', 'synthlidar', 'semanticPOSS']:
@@ -69,7 +122,8 @@ def get_dataset(dataset_name, cfg, ds_cfg, data_dir, split, limited_view=False,
           limited_view=limited_view,
           finesize=cfg.img_prop.finesize if (split == 'train' and cfg.img_prop.finesize != -1) else None,
           norm_label=norm_label,
-          is_ref_semposs=is_ref_semposs
+          is_ref_semposs=is_ref_semposs,
+          batch_transform=getattr(cfg, 'batch_transform', False)
       )
   elif dataset_name =='nuscene':
     dataset = NuScene(
@@ -81,10 +135,61 @@ def get_dataset(dataset_name, cfg, ds_cfg, data_dir, split, limited_view=False,
           modality=cfg.modality,
           is_sorted=False,
           is_raw=ds_cfg.is_raw,
-          fill_in_label=cfg.fill_in_label
+          fill_in_label=cfg.fill_in_label,
+          batch_transform=getattr(cfg, 'batch_transform', False)
       )
   return dataset
 
+def get_loader_cfg(cfg):
+  # optional `loader` section of the training yaml
+  loader_cfg = getattr(cfg, 'loader', None)
+  return {
+    'num_workers': getattr(loader_cfg, 'num_workers', 4),
+    'pin_memory': getattr(loader_cfg, 'pin_memory', torch.cuda.is_available()),
+    'persistent_workers': getattr(loader_cfg, 'persistent_workers', True),
+    'prefetch_factor': getattr(loader_cfg, 'prefetch_factor', 2),
+  }
+
+def build_loader(dataset, batch_size, shuffle, drop_last, num_workers=4, pin_memory=False, persistent_workers=True, prefetch_factor=2, seed=0):
+  kwargs = {}
+  if isinstance(dataset, torch.utils.data.IterableDataset):
+    # order and shuffling are handled by the stream itself
+    shuffle = False
+    dataset.set_batching(batch_size, num_workers, drop_last)
+  elif isinstance(dataset, BinaryScan):
+    kwargs['sampler'] = UnpairedSampler(dataset, shuffle, interleave=batch_size, seed=seed)
+    shuffle = False
+  if num_workers > 0:
+    # keep the worker pool alive across epochs instead of re-forking it
+    kwargs.update(persistent_workers=persistent_workers, prefetch_factor=prefetch_factor)
+  return torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers, drop_last=drop_last,
+                                     collate_fn=dataset.collate_fn, pin_memory=pin_memory, worker_init_fn=seed_worker, **kwargs)
+
+def autotune_loader(dataset, batch_size, loader_cfg, seconds=3.0, worker_candidates=(2, 4, 8, 12), prefetch_candidates=(2, 4)):
+  # time a few worker/prefetch settings on the real dataset and keep the fastest
+  max_workers = os.cpu_count() or 1
+  worker_candidates = sorted({min(w, max_workers) for w in worker_candidates})
+  best_cfg, best_rate = dict(loader_cfg), 0.0
+  for num_workers in worker_candidates:
+    for prefetch_factor in prefetch_candidates:
+      cand = dict(loader_cfg, num_workers=num_workers, prefetch_factor=prefetch_factor, persistent_workers=False)
+      loader = build_loader(dataset, batch_size, True, True, **cand)
+      it = iter(loader)
+      next(it)  # exclude worker start-up
+      n_batches, start = 0, time.time()
+      for _ in it:
+        n_batches += 1
+        if time.time() - start > seconds:
+          break
+      rate = n_batches / (time.time() - start)
+      del it, loader
+      print(f'loader autotune: num_workers={num_workers} prefetch_factor={prefetch_factor}: {rate:.2f} batch/s')
+      if rate > best_rate:
+        best_rate = rate
+        best_cfg = dict(cand, persistent_workers=loader_cfg['persistent_workers'])
+  print(f"loader autotune: using num_workers={best_cfg['num_workers']} prefetch_factor={best_cfg['prefetch_factor']}")
+  return best_cfg
+
 def get_data_loader(cfg, split, batch_size, dataset_name='', shuffle=True, two_dataset_enabled=True, is_ref_semposs=False):
   cfg_A = cfg.dataset.dataset_A
   norm_label = cfg.model.norm_label
@@ -92,14 +197,29 @@ def get_data_loader(cfg, split, batch_size, dataset_name='', shuffle=True, two_d
   ds_cfg_A = make_class_from_dict(yaml.safe_load(open(f'configs/dataset_cfg/{dataset_name_A}_cfg.yml', 'r')))
   data_dir = cfg_A.data_dir if dataset_name == '' else ds_cfg_A.data_dir
   limited_view = 'rgb' in cfg.model.modality_A or 'rgb' in cfg.model.modality_B
+  seed = getattr(getattr(cfg, 'training', None), 'seed', 0)
   dataset_A = get_dataset(dataset_name_A, cfg_A, ds_cfg_A, data_dir, split, limited_view, is_ref_semposs, norm_label)
-  dataset = dataset_A
+  stream_cfg_A = streaming_cfg(cfg_A)
+  dataset = StreamingDataset(dataset_A, shuffle=shuffle, seed=seed, **stream_cfg_A) if stream_cfg_A else dataset_A
   if hasattr(cfg.dataset, 'dataset_B') and two_dataset_enabled:
     cfg_B = cfg.dataset.dataset_B
     ds_cfg_B = make_class_from_dict(yaml.safe_load(open(f'configs/dataset_cfg/{cfg_B.name}_cfg.yml', 'r')))
     dataset_B = get_dataset(cfg.dataset.dataset_B.name, cfg_B, ds_cfg_B, cfg_B.data_dir, split, limited_view, is_ref_semposs, norm_label)
-    dataset = BinaryScan(dataset_A, dataset_B)
-  loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=4, drop_last=True if split == 'train' else False)
+    stream_cfg_B = streaming_cfg(cfg_B)
+    if stream_cfg_A or stream_cfg_B:
+      stream_A = dataset if stream_cfg_A else StreamingDataset(dataset_A, shuffle=shuffle, seed=seed)
+      stream_B = StreamingDataset(dataset_B, shuffle=True, seed=seed + 1, **(stream_cfg_B or {}))
+      dataset = StreamingBinaryScan(stream_A, stream_B, BinaryScan(dataset_A, dataset_B))
+    else:
+      dataset = BinaryScan(dataset_A, dataset_B)
+  loader_cfg = get_loader_cfg(cfg)
+  if getattr(getattr(cfg, 'loader', None), 'autotune', False):
+    # tune once on the first loader built, the others reuse the result
+    loader_cfg = autotune_loader(dataset, batch_size, loader_cfg)
+    cfg.loader.autotune = False
+    for k, v in loader_cfg.items():
+      setattr(cfg.loader, k, v)
+  loader = build_loader(dataset, batch_size, shuffle, True if split == 'train' else False, seed=seed, **loader_cfg)
   
   return loader, dataset
 
@@ -0,0 +1,43 @@
+import hashlib
+import os
+import os.path as osp
+
+import numpy as np
+
+
+class FillCache():
+    """On-disk cache of the nearest-valid-pixel index map used by `fill`.
+
+    Entries are keyed by the source file, its mtime and the preprocessing
+    config, so touching the file or changing the config simply misses and
+    recomputes the distance transform.
+    """
+
+    def __init__(self, cache_dir, config):
+        self.cache_dir = cache_dir
+        self.config = '|'.join(f'{k}={v}' for k, v in sorted(config.items()))
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, src_path, stat_path=None):
+        mtime = os.stat(stat_path or src_path).st_mtime_ns
+        return hashlib.md5(f'{src_path}|{mtime}|{self.config}'.encode()).hexdigest()
+
+    def get(self, key):
+        path = osp.join(self.cache_dir, key + '.npy')
+        if not osp.exists(path):
+            return None
+        try:
+            return tuple(np.load(path).astype(np.intp))
+        except (ValueError, OSError):
+            # truncated write from a killed worker
+            return None
+
+    def put(self, key, ind):
+        path = osp.join(self.cache_dir, key + '.npy')
+        # indices of a range image fit in int16/int32, keep the entries small
+        top = max((int(i.max()) for i in ind if i.size), default=0)
+        dtype = np.int16 if top < np.iinfo(np.int16).max else np.int32
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.stack(ind).astype(dtype))
+        os.replace(tmp_path, path)
@@ -3,6 +3,8 @@ import numpy as np
 import torch
 from torch.utils.data import Dataset
 from laserscan import LaserScan, SemLaserScan
+from util.label_mapper import LabelMapper
+from dataset.manifest import load_manifest
 import torch.nn.functional as F
 from torchvision import transforms
 import yaml
@@ -52,6 +54,14 @@ class SemanticKitti(Dataset):
     self.sensor_foh_left = sensor['foh_left']
     self.max_points = max_points
     self.gt = gt
+    # only holds the projection parameters, see LaserScan.project_batch
+    self.scan = LaserScan(project=True,
+                          H=self.sensor_img_H,
+                          W=self.sensor_img_W,
+                          fov_up=self.sensor_fov_up,
+                          fov_down=self.sensor_fov_down,
+                          foh_left=self.sensor_foh_left,
+                          foh_right=self.sensor_foh_right)
 
     # get number of classes (can't be len(self.learning_map) because there
     # are multiple repeated entries, so the number that matters is how many
@@ -93,11 +103,11 @@ class SemanticKitti(Dataset):
       scan_path = os.path.join(self.root, seq, "velodyne")
       label_path = os.path.join(self.root, seq, "labels")
 
-      # get files
-      scan_files = [os.path.join(dp, f) for dp, dn, fn in os.walk(
-          os.path.expanduser(scan_path)) for f in fn if is_scan(f)]
-      label_files = [os.path.join(dp, f) for dp, dn, fn in os.walk(
-          os.path.expanduser(label_path)) for f in fn if is_label(f)]
+      # get files from the cached manifests instead of walking the tree
+      scan_files = [f for f in load_manifest(os.path.join(self.root, seq + '_scan_manifest.npz'),
+                    {int(seq): os.path.expanduser(scan_path)}).path.tolist() if is_scan(f)]
+      label_files = [f for f in load_manifest(os.path.join(self.root, seq + '_label_manifest.npz'),
+                     {int(seq): os.path.expanduser(label_path)}, point_dim=None).path.tolist() if is_label(f)]
       # check all scans have labels
       if self.gt:
         assert(len(scan_files) == len(label_files))
@@ -114,68 +124,19 @@ class SemanticKitti(Dataset):
                                                     self.sequences))
 
   def __getitem__(self, index):
-    # get item in tensor shape
-    scan_file = self.scan_files[index]
-    if self.gt:
-      label_file = self.label_files[index]
-
-    # open a semantic laserscan
-    if self.gt:
-      scan = SemLaserScan(self.color_map,
-                          project=True,
-                          H=self.sensor_img_H,
-                          W=self.sensor_img_W,
-                          fov_up=self.sensor_fov_up,
-                          fov_down=self.sensor_fov_down,
-                          foh_left=self.sensor_foh_left,
-                          foh_right=self.sensor_foh_right)
-    else:
-      scan = LaserScan(project=True,
-                       H=self.sensor_img_H,
-                       W=self.sensor_img_W,
-                       fov_up=self.sensor_fov_up,
-                       fov_down=self.sensor_fov_down,
-                       foh_left=self.sensor_foh_left,
-                       foh_right=self.sensor_foh_right)
-
-    # open and obtain scan
-    scan.open_scan(scan_file)
-    if self.gt:
-      scan.open_label(label_file)
-      # map unused classes to used classes (also for projection)
-      scan.sem_label = self.map(scan.sem_label, self.learning_map)
-      scan.proj_sem_label = self.map(scan.proj_sem_label, self.learning_map)
-
-    # make a tensor of the uncompressed data (with the max num points)
-    unproj_n_points = scan.points.shape[0]
-    unproj_xyz = torch.full((self.max_points, 3), -1.0, dtype=torch.float)
-    unproj_xyz[:unproj_n_points] = torch.from_numpy(scan.points)
-    unproj_range = torch.full([self.max_points], -1.0, dtype=torch.float)
-    unproj_range[:unproj_n_points] = torch.from_numpy(scan.unproj_range)
-    unproj_remissions = torch.full([self.max_points], -1.0, dtype=torch.float)
-    unproj_remissions[:unproj_n_points] = torch.from_numpy(scan.remissions)
-    if self.gt:
-      unproj_labels = torch.full([self.max_points], -1.0, dtype=torch.int32)
-      unproj_labels[:unproj_n_points] = torch.from_numpy(scan.sem_label)
-    else:
-      unproj_labels = []
-    # get points and labels
-    proj_range = torch.from_numpy(scan.proj_range).clone()
-    proj_xyz = torch.from_numpy(scan.proj_xyz).clone()
-    proj_remission = torch.from_numpy(scan.proj_remission).clone()
-    proj_mask = torch.from_numpy(scan.proj_mask)
-    if self.gt:
-      proj_labels = torch.from_numpy(scan.proj_sem_label).clone()
-      proj_labels = proj_labels * proj_mask
-    else:
-      proj_labels = []
-    proj_x = torch.full([self.max_points], -1, dtype=torch.long)
-    proj_x[:unproj_n_points] = torch.from_numpy(scan.proj_x)
-    proj_y = torch.full([self.max_points], -1, dtype=torch.long)
-    proj_y[:unproj_n_points] = torch.from_numpy(scan.proj_y)
-    proj = torch.cat([proj_range.unsqueeze(0).clone(),
-                      proj_xyz.clone().permute(2, 0, 1),
-                      proj_remission.unsqueeze(0).clone()])
+    return self.__getitems__([index])[0]
+
+  def __getitems__(self, indices):
+    # the DataLoader hands over the indices of a whole batch, which are
+    # projected in one go
+    scans = [np.fromfile(self.scan_files[i], dtype=np.float32).reshape((-1, 4)) for i in indices]
+    out = self.scan.project_batch([s[:, :3] for s in scans], [s[:, 3] for s in scans])
+
+    # get points
+    proj_mask = torch.from_numpy(out['proj_mask'])[:, None]
+    proj = torch.cat([torch.from_numpy(out['proj_range'])[:, None],
+                      torch.from_numpy(out['proj_xyz']).permute(0, 3, 1, 2),
+                      torch.from_numpy(out['proj_remission'])[:, None]], dim=1)
     self.empirical_max = self.sensor_img_means[:, None, None] + 4*self.sensor_img_stds[:, None, None]
     self.empirical_min = self.sensor_img_means[:, None, None] - 4*self.sensor_img_stds[:, None, None]
 
@@ -183,15 +144,9 @@ class SemanticKitti(Dataset):
             ) / (self.empirical_max - self.empirical_min)
     proj = proj.clamp(0.0 , 1.0)
     proj = proj * proj_mask.float()
-
-    # get name and sequence
-    path_norm = os.path.normpath(scan_file)
-    path_split = path_norm.split(os.sep)
-    path_seq = path_split[-3]
-    path_name = path_split[-1].replace(".bin", ".label")
-    proj = proj.repeat_interleave(4 , dim=1)
+    proj = proj.repeat_interleave(4 , dim=2)
     proj = (proj - 0.5)/0.5
-    return proj[1:4], proj[4:5], proj[0:1]
+    return [(p[1:4], p[4:5], p[0:1]) for p in proj]
 
   def __len__(self):
     return len(self.scan_files)
@@ -200,27 +155,7 @@ class SemanticKitti(Dataset):
   def map(label, mapdict):
     # put label from original values to xentropy
     # or vice-versa, depending on dictionary values
-    # make learning map a lookup table
-    maxkey = 0
-    for key, data in mapdict.items():
-      if isinstance(data, list):
-        nel = len(data)
-      else:
-        nel = 1
-      if key > maxkey:
-        maxkey = key
-    # +100 hack making lut bigger just in case there are unknown labels
-    if nel > 1:
-      lut = np.zeros((maxkey + 100, nel), dtype=np.int32)
-    else:
-      lut = np.zeros((maxkey + 100), dtype=np.int32)
-    for key, data in mapdict.items():
-      try:
-        lut[key] = data
-      except IndexError:
-        print("Wrong key ", key)
-    # do the mapping
-    return lut[label]
+    return LabelMapper.get(mapdict)(label)
 
 
 class Kitti_Loader():
@@ -368,10 +303,8 @@ class Kitti_Loader():
     return SemanticKitti.map(label, self.learning_map)
 
   def to_color(self, label):
-    # put label in original values
-    label = SemanticKitti.map(label, self.learning_map_inv)
-    # put label in color
-    return SemanticKitti.map(label, self.color_map)
+    # put label in original values, then in color
+    return LabelMapper.get(self.learning_map_inv, self.color_map)(label)
 
 
 if __name__ == "__main__":
@@ -472,10 +405,8 @@ if __name__ == "__main__":
   from tqdm import trange
   import tqdm
   dest_dir = FLAGS.dest_dir
-  x = [0.0 for i in range(5)]
-  x2 = [0.0 for i in range(5)]
-  num = 0
-  min_max = [[np.inf, -np.inf] for i in range(5)]
+  # channel mean/std/min/max come from the single statistics pass of
+  # pre_process_dataset.py (dataset/statistics.py), not from this conversion
 
   for scan_path in tqdm.tqdm(scan_files_list, total=len(scan_files_list)):
     scan.open_scan(scan_path)
@@ -503,20 +434,6 @@ if __name__ == "__main__":
     splited = scan_path.split('/')
     filename = 'seq_' + splited[-3] + '_velodyne_' + splited[-1].split('.')[0] + '.npy'
     np.save(os.path.join(dest_dir, filename), proj)
-    num += (proj_mask == 1.0).sum()
-    for i in range(5):
-      if i == 4:
-        break
-      x[i] += (proj[i:i+1][proj_mask == 1.0]).sum()
-      x2[i] += ((proj[i :i+1]**2)[proj_mask == 1.0]).sum()
-      min_max[i][0] = min(min_max[i][0], (proj[i:i+1][proj_mask == 1.0]).min())
-      min_max[i][1] = max(min_max[i][1], (proj[i:i+1][proj_mask == 1.0]).max())
-
-  mu = [x[i]/num for i in range(len(x))]
-  sig = [np.sqrt(x2[i]/num - mu[i]**2) for i in range(len(x))]
-  print(mu, '\n')
-  print(sig, '\n')
-  print(min_max)
 
 
 
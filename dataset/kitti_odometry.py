@@ -1,5 +1,6 @@
 
 import os
+import hashlib
 import os.path as osp
 import numpy as np
 import torch
@@ -9,15 +10,21 @@ import torchvision.transforms.functional as TF
 from glob import glob
 import random
 from util.lidar import point_cloud_to_xyz_image
-from util import _map
+from util import _map, LabelMapper
+from dataset.shard import SequenceShard, has_shard
+from dataset.fill_cache import FillCache
+from dataset.sample_cache import SharedSampleCache, DEFAULT_DIR
+from dataset.camera import CameraProjection, open_image, image_to_pcl
+from dataset.batch_transform import BatchTransform
+from dataset.manifest import Manifest, load_manifest
 from PIL import Image
 from scipy import ndimage as nd
 from collections import namedtuple
 import torchvision.transforms as transforms
 
 
-def car2hom(pc):
-    return np.concatenate([pc[:, :3], np.ones((pc.shape[0], 1), dtype=pc.dtype)], axis=-1)
+MANIFEST_FILE = 'manifest.npz'
+
 
 class  KITTIOdometry(torch.utils.data.Dataset):
     def __init__(
@@ -33,7 +40,8 @@ class  KITTIOdometry(torch.utils.data.Dataset):
         limited_view=False,
         finesize=None,
         norm_label=False,
-        is_ref_semposs=False):
+        is_ref_semposs=False,
+        batch_transform=False):
         super().__init__()
         self.root = osp.join(root, "sequences")
         if '/' in split:
@@ -59,14 +67,49 @@ class  KITTIOdometry(torch.utils.data.Dataset):
         else :
             self.has_label=False
         self.limited_view = limited_view
+        if self.has_label:
+            # projected PNG labels are already learning_map'ed except for semanticPOSS
+            if self.is_raw or name == 'semanticPOSS':
+                self.label_mapper = LabelMapper.get(DATA.learning_map, DATA.m_learning_map)
+            else:
+                self.label_mapper = LabelMapper.get(DATA.m_learning_map)
         self.finesize = finesize
         self.norm_label = norm_label
         self.is_ref_semposs = is_ref_semposs
+        # flip/resize/crop deferred to the collate function, once per batch
+        self.batch_transform = BatchTransform(self.shape, self.flip, self.finesize) if batch_transform else None
+        self.collate_fn = self.batch_transform.collate if batch_transform else None
+        self.use_shards = getattr(DATA, 'use_shards', False) and not self.is_raw
+        self.shards = None
+        self.fill_cache = None
+        if getattr(DATA, 'fill_cache', False) and (self.fill_in_label or self.name == 'carla'):
+            cache_dir = DATA.fill_cache if isinstance(DATA.fill_cache, str) else osp.join(root, 'fill_cache')
+            self.fill_cache = FillCache(cache_dir, {'fill_in_label': fill_in_label, 'name': name, 'min_depth': self.min_depth, 'max_depth': self.max_depth})
+        self.sample_cache = None
+        sample_cache = getattr(DATA, 'sample_cache', False)
+        if sample_cache:
+            # `sample_cache:` may be `true` or a dict with `dir` and `budget_mb`
+            self.sample_cache = SharedSampleCache(
+                getattr(sample_cache, 'dir', DEFAULT_DIR),
+                int(getattr(sample_cache, 'budget_mb', 8192)) * 1024 ** 2,
+                {'name': name, 'modality': ','.join(modality), 'fill_in_label': fill_in_label, 'norm_label': norm_label,
+                 'min_depth': self.min_depth, 'max_depth': self.max_depth, 'limited_view': limited_view,
+                 'is_ref_semposs': is_ref_semposs, 'shape': (DATA.height, DATA.width), 'is_raw': self.is_raw,
+                 'use_shards': self.use_shards,
+                 # the composed label LUT covers learning_map and m_learning_map
+                 'label_lut': hashlib.md5(self.label_mapper.lut.tobytes()).hexdigest() if self.has_label else None})
         if self.has_rgb:
             self.has_rgb = True
             calib = self.load_calib()
             self.velo_to_camera_rect =calib.T_cam2_velo
             self.cam_intrinsic = calib.P_rect_20
+            self.camera = CameraProjection(self.velo_to_camera_rect, self.cam_intrinsic)
+            # per-point colours of the raw scans, kept next to the dataset so that
+            # a hit skips both the PNG decode and the camera projection
+            self.rgb_cache = None
+            if getattr(DATA, 'rgb_cache', False) and self.is_raw:
+                cache_dir = DATA.rgb_cache if isinstance(DATA.rgb_cache, str) else osp.join(root, 'point_rgb')
+                self.rgb_cache = FillCache(cache_dir, {'P': self.camera.rot.tobytes().hex() + self.camera.trans.tobytes().hex()})
         self.load_datalist()
 
     def load_calib(self):
@@ -135,19 +178,73 @@ class  KITTIOdometry(torch.utils.data.Dataset):
         return calib
 
     
-    def fill(self, data, invalid=None):
-        if invalid is None: invalid = np.isnan(data)
-        ind = nd.distance_transform_edt(invalid, return_distances=False, return_indices=True)
+    def fill(self, data, invalid=None, ind=None):
+        if ind is None:
+            if invalid is None: invalid = np.isnan(data)
+            ind = nd.distance_transform_edt(invalid, return_distances=False, return_indices=True)
         return data[tuple(ind)]
 
+    def fill_indices(self, invalid, src=None):
+        # one EDT per sample, shared by every filled modality and cached on disk
+        if self.fill_cache is None or src is None:
+            return tuple(nd.distance_transform_edt(invalid, return_distances=False, return_indices=True))
+        key = self.fill_cache.key(*src)
+        ind = self.fill_cache.get(key)
+        if ind is None:
+            ind = tuple(nd.distance_transform_edt(invalid, return_distances=False, return_indices=True))
+            self.fill_cache.put(key, ind)
+        return ind
+
+    def source_stamp(self, index):
+        # (path used in the cache key, file whose mtime invalidates it)
+        points_path = self.datalist[index]
+        if self.use_shards and self.shard_pos[index] is not None:
+            return points_path, self.shards[self.shard_pos[index][0]].records_path
+        return points_path, points_path
+
+    def source_files(self, index):
+        # every file load_frame reads for the frame
+        files = [self.source_stamp(index)[1]]
+        if self.has_label and not (self.use_shards and self.shard_pos[index] is not None):
+            files.append(self.label_list[index])
+        if self.has_rgb:
+            files.append(self.rgb_list[index])
+        if self.tag_list is not None:
+            files.append(self.tag_list[index])
+        return files
+
     def load_datalist(self):
-        datalist = []
+        datalist, seq_ids, frame_ids = [], [], []
         print("Subsets ",self.subsets)
+        if self.use_shards:
+            self.shards = {}
+            self.shard_pos = []
+        seq_dirs = {int(subset): osp.join(self.root, str(subset).zfill(2), 'velodyne') for subset in self.subsets}
+        manifest = load_manifest(osp.join(self.root, MANIFEST_FILE), seq_dirs, point_dim=4,
+                                 verify=getattr(self.DATA, 'verify_manifest', False))
         for subset in self.subsets:
             subset_dir = osp.join(self.root, str(subset).zfill(2))
-            sub_point_paths = sorted(glob(osp.join(subset_dir, "velodyne/*")))
-            datalist += list(sub_point_paths)
+            shard = SequenceShard(subset_dir) if self.use_shards and has_shard(subset_dir) else None
+            if shard is not None and self.has_label and not shard.has_label:
+                # the label field of such a shard is all zeros, read the label files instead
+                print(f"Shard of {subset_dir} has no labels, loading the sequence from files")
+                shard = None
+            if shard is not None:
+                self.shards[subset_dir] = shard
+                sub_point_paths = [osp.join(subset_dir, 'velodyne', str(f).zfill(6) + '.npy') for f in shard.index['frame']]
+                sub_frames = shard.index['frame']
+                self.shard_pos += [(subset_dir, i) for i in range(len(shard))]
+            else:
+                sub_manifest = manifest.select([subset])
+                sub_point_paths = sub_manifest.path.tolist()
+                sub_frames = sub_manifest.frame
+                if self.use_shards:
+                    self.shard_pos += [None] * len(sub_point_paths)
+            datalist += sub_point_paths
+            seq_ids.append(np.full(len(sub_point_paths), int(subset), dtype=np.int64))
+            frame_ids.append(np.asarray(sub_frames, dtype=np.int64))
         self.datalist = datalist
+        self.frame_ids = Manifest({'seq': np.concatenate(seq_ids), 'frame': np.concatenate(frame_ids)})
         if self.has_label:
             self.label_list = [d.replace('velodyne', 'labels').replace('bin' if self.is_raw else 'npy', 'label' if self.is_raw else 'png') for d in self.datalist]
         if self.has_rgb:
@@ -155,20 +252,23 @@ class  KITTIOdometry(torch.utils.data.Dataset):
         self.tag_list = [d.replace('velodyne', 'tag').replace('bin', 'tag') for d in self.datalist] if self.name == 'semanticPOSS' and self.is_raw else None
         print("taille data",len(self.datalist))
 
-    def preprocess(self, out):
+    def preprocess(self, out, src=None):
         out["depth"] = np.linalg.norm(out["points"], ord=2, axis=2)
+        # shards carry the valid-return mask, otherwise derive it from depth
+        valid = out["mask"] if "mask" in out else out["depth"] > 0.0
+        ind = None
+        if ('label' in out and self.fill_in_label) or self.name == 'carla':
+            ind = self.fill_indices(~ valid, src)
         if 'label' in out and self.fill_in_label:
-          fill_in_mask = ~ (out["depth"] > 0.0)
-          out['label'] = self.fill(out['label'], fill_in_mask)
+          out['label'] = self.fill(out['label'], ind=ind)
         if self.name == 'carla':
-            fill_in_mask = ~ (out["depth"] > 0.0)
-            out['depth'] = self.fill(out['depth'], fill_in_mask)
+            out['depth'] = self.fill(out['depth'], ind=ind)
             if 'reflectance' in out:
-                out['reflectance'] = self.fill(out['reflectance'], fill_in_mask)
+                out['reflectance'] = self.fill(out['reflectance'], ind=ind)
             if 'rgb' in out:
-                out['rgb'] = self.fill(out['rgb'], fill_in_mask)
+                out['rgb'] = self.fill(out['rgb'], ind=ind)
         mask = (
-            (out["depth"] > 0.0)
+            valid
             & (out["depth"] > self.min_depth)
             & (out["depth"] < self.max_depth)
         )
@@ -199,29 +299,75 @@ class  KITTIOdometry(torch.utils.data.Dataset):
             out[k] = v
         return out
 
-    def image_to_pcl(self, rgb_image, point_cloud):
-        rgb = np.zeros((len(point_cloud),3), dtype=np.int32)
-        height, width, _ = rgb_image.shape
-        hom_pcl_points = car2hom(point_cloud[:, :3]).T
-        pcl_in_cam_rect = np.dot(self.velo_to_camera_rect, hom_pcl_points)
-        pcl_in_image = np.dot(self.cam_intrinsic, pcl_in_cam_rect)
-        pcl_in_image = np.array([pcl_in_image[0] / pcl_in_image[2], pcl_in_image[1] / pcl_in_image[2], pcl_in_image[2]])
-        canvas_mask = (pcl_in_image[0] > 0.0) & (pcl_in_image[0] < width) & (pcl_in_image[1] > 0.0)\
-            & (pcl_in_image[1] < height) & (pcl_in_image[2] > 0.0)
-        valid_pcl_in_image = pcl_in_image[:, canvas_mask].astype('int32')
-        rgb[canvas_mask] = rgb_image[valid_pcl_in_image[1], valid_pcl_in_image[0], :]
+    def image_to_pcl(self, index, point_cloud):
+        if self.rgb_cache is None:
+            return image_to_pcl(self.camera, open_image(self.rgb_list[index]), point_cloud)
+        # the colours depend on the scan and on the image, both stamps go in the key
+        points_path = self.datalist[index]
+        key = self.rgb_cache.key(f'{points_path}@{os.stat(points_path).st_mtime_ns}', self.rgb_list[index])
+        rgb = self.rgb_cache.get(key)
+        if rgb is not None:
+            return np.stack(rgb, axis=1)
+        rgb = image_to_pcl(self.camera, open_image(self.rgb_list[index]), point_cloud)
+        # stored channel-first, FillCache entries are tuples of index-like arrays
+        self.rgb_cache.put(key, rgb.T)
         return rgb
 
+    def load_from_shard(self, index):
+        # fields are copy-on-write memmap views, nothing is read until touched
+        seq_dir, pos = self.shard_pos[index]
+        shard = self.shards[seq_dir]
+        rec = shard[pos]
+        if not self.has_label:
+            return rec, None
+        if not shard.has_label:
+            raise ValueError(f"Shard of {seq_dir} was packed without labels")
+        sem_label = self.label_mapper(rec['label']).astype('float32')[..., None]
+        return rec, sem_label
+
     def __getitem__(self, index):
         points_path = self.datalist[index]
+        out = None
+        if self.sample_cache is not None:
+            key = self.sample_cache.key(points_path, *self.source_files(index))
+            out = self.sample_cache.get(key)
+        if out is None:
+            out = self.load_preprocessed(index)
+            if self.sample_cache is not None:
+                self.sample_cache.put(key, out)
+        if self.batch_transform is None:
+            out = self.transform(out)
+        out['path'] = points_path
+        return out
+
+    def load_preprocessed(self, index):
+        return self.preprocess(self.load_frame(index), self.source_stamp(index))
+
+    def load_frame(self, index):
+        # decoded modalities of one frame, before fill-in and normalisation
+        if self.use_shards and self.shard_pos[index] is not None:
+            rec, sem_label = self.load_from_shard(index)
+            out = {"points": rec['points']}
+            if "reflectance" in self.modality:
+                out["reflectance"] = rec['reflectance']/255.0 if self.name == 'semanticPOSS' else rec['reflectance']
+            if "label" in self.modality and self.has_label:
+                out["label"] = sem_label / (10.0 if self.name == 'semanticPOSS' else 19.0) if self.norm_label else sem_label
+                out['lwo'] = sem_label.copy()
+                if self.name == 'carla' and self.is_ref_semposs:
+                    out['lwo'] = _map(out['lwo'].astype('int'), self.DATA.kitti_to_POSS_map).astype(np.float32)
+            if self.has_rgb:
+                rgb = np.array(Image.open(self.rgb_list[index])).astype('float32') / 255.0
+                black_pos = (rgb == 0.0).all(2)
+                rgb[black_pos] = np.mean(rgb[~black_pos], axis=0)
+                out["rgb"] = rgb
+            out["mask"] = rec['mask']
+            return out
+        points_path = self.datalist[index]
         if not self.is_raw:
             points = np.load(points_path).astype(np.float32)
             if self.has_label:
                 labels_path = self.label_list[index]
-                sem_label = np.array(Image.open(labels_path))
-                if self.name == 'semanticPOSS':
-                    sem_label = _map(sem_label, self.DATA.learning_map)
-                sem_label = _map(sem_label, self.DATA.m_learning_map)
+                sem_label = self.label_mapper(np.array(Image.open(labels_path)))
                 points = np.concatenate([points, sem_label.astype('float32')[..., None]], axis=-1)
             if self.has_rgb:
                 rgb_path = self.rgb_list[index]
@@ -238,15 +384,13 @@ class  KITTIOdometry(torch.utils.data.Dataset):
                 if self.name in ['kitti', 'carla', 'semanticPOSS']:
                     label = np.fromfile(labels_path, dtype=np.int32)
                     sem_label = label & 0xFFFF 
-                    sem_label = _map(_map(sem_label, self.DATA.learning_map), self.DATA.m_learning_map)
+                    sem_label = self.label_mapper(sem_label)
                 elif self.name == 'synthlidar':
                     sem_label = np.fromfile(labels_path, dtype=np.uint32)
-                    sem_label = _map(_map(sem_label, self.DATA.learning_map), self.DATA.m_learning_map)
+                    sem_label = self.label_mapper(sem_label)
                 point_cloud = np.concatenate([point_cloud, sem_label.astype('float32')[:, None]], axis=1)
             if self.has_rgb:
-                rgb_path = self.rgb_list[index]
-                rgb_image = np.array(Image.open(rgb_path))
-                rgb = self.image_to_pcl(rgb_image, point_cloud)
+                rgb = self.image_to_pcl(index, point_cloud)
                 point_cloud = np.concatenate([point_cloud, rgb.astype('float32')], axis=1)
             H , W = self.DATA.height, self.DATA.width
             fov_up, fov_down = self.DATA.fov_up, self.DATA.fov_down
@@ -270,10 +414,11 @@ class  KITTIOdometry(torch.utils.data.Dataset):
             black_pos = (out["rgb"] == 0.0).all(2)
             avg_color = np.mean(out["rgb"][~black_pos], axis=0)
             out["rgb"][black_pos] = avg_color
-        out = self.preprocess(out)
-        out = self.transform(out)
-        out['path'] = points_path
         return out
 
+    def index_of(self, seq, frame):
+        # (sequence, frame id) -> dataset index
+        return self.frame_ids.index_of(seq, frame)
+
     def __len__(self):
         return len(self.datalist)
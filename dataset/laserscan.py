@@ -16,41 +16,52 @@ class LaserScan:
     self.proj_foh_left = foh_left
     self.proj_foh_right = foh_right
     self.have_rgb = have_rgb
+    self.points_rgb = None
+    self.alloc()
     self.reset()
 
+  def alloc(self):
+    """ Allocate the projection buffers, reset() refills them in place. """
+    # projected range image - [H,W] range (-1 is no data)
+    self.proj_range = np.empty((self.proj_H, self.proj_W), dtype=np.float32)
+
+    # projected point cloud xyz - [H,W,3] xyz coord (-1 is no data)
+    self.proj_xyz = np.empty((self.proj_H, self.proj_W, 3), dtype=np.float32)
+
+    # projected remission - [H,W] intensity (-1 is no data)
+    self.proj_remission = np.empty((self.proj_H, self.proj_W), dtype=np.float32)
+    self.proj_points_rgb = np.empty((self.proj_H, self.proj_W, 3),
+                                    dtype=np.uint8) if self.have_rgb else None
+    # projected index (for each pixel, what I am in the pointcloud)
+    # [H,W] index (-1 is no data)
+    self.proj_idx = np.empty((self.proj_H, self.proj_W), dtype=np.int32)
+
+    # mask containing for each pixel, if it contains a point or not
+    self.proj_mask = np.empty((self.proj_H, self.proj_W), dtype=np.int32)
+
+    # scratch buffer, nearest depth of every pixel
+    self.proj_nearest = np.empty(self.proj_H * self.proj_W, dtype=np.float32)
+
   def reset(self):
     """ Reset scan members. """
     self.points = np.zeros((0, 3), dtype=np.float32)        # [m, 3]: x, y, z
     self.remissions = np.zeros((0, 1), dtype=np.float32)    # [m ,1]: remission
 
-    # projected range image - [H,W] range (-1 is no data)
-    self.proj_range = np.full((self.proj_H, self.proj_W), -1,
-                              dtype=np.float32)
-
     # unprojected range (list of depths for each point)
     self.unproj_range = np.zeros((0, 1), dtype=np.float32)
 
-    # projected point cloud xyz - [H,W,3] xyz coord (-1 is no data)
-    self.proj_xyz = np.full((self.proj_H, self.proj_W, 3), -1,
-                            dtype=np.float32)
-
-    # projected remission - [H,W] intensity (-1 is no data)
-    self.proj_remission = np.full((self.proj_H, self.proj_W), -1,
-                                  dtype=np.float32)
-    self.proj_points_rgb = np.full((self.proj_H, self.proj_W, 3), 0,
-                                   dtype=np.uint8) if self.have_rgb else None
-    # projected index (for each pixel, what I am in the pointcloud)
-    # [H,W] index (-1 is no data)
-    self.proj_idx = np.full((self.proj_H, self.proj_W), -1,
-                            dtype=np.int32)
+    self.proj_range.fill(-1)
+    self.proj_xyz.fill(-1)
+    self.proj_remission.fill(-1)
+    if self.have_rgb:
+      self.proj_points_rgb.fill(0)
+    self.proj_idx.fill(-1)
 
     # for each point, where it is in the range image
     self.proj_x = np.zeros((0, 1), dtype=np.int32)        # [m, 1]: x
     self.proj_y = np.zeros((0, 1), dtype=np.int32)        # [m, 1]: y
 
-    # mask containing for each pixel, if it contains a point or not
-    self.proj_mask = np.ones((self.proj_H, self.proj_W),
-                              dtype=np.int32)       # [H,W] mask
+    self.proj_mask.fill(1)
 
   def size(self):
     """ Return the size of the point cloud. """
@@ -109,11 +120,10 @@ class LaserScan:
     if self.project:
       self.do_range_projection()
 
-  def do_range_projection(self):
-    """ Project a pointcloud into a spherical projection image.projection.
-        Function takes no arguments because it can be also called externally
-        if the value of the constructor was not set (in case you change your
-        mind about wanting the projection)
+  def image_coords(self, points):
+    """ Pixel of every point inside the horizontal field of view.
+        Returns the field of view mask and, for the points inside it,
+        proj_x, proj_y (int32) and depth (float32).
     """
     # laser parameters
     fov_up = self.proj_fov_up / 180.0 * np.pi      # field of view up in rad
@@ -123,73 +133,115 @@ class LaserScan:
     foh_right = self.proj_foh_right / 180.0 * np.pi
     foh = abs(foh_left) + abs(foh_right)
 
-    # get depth of all points
-    depth = np.linalg.norm(self.points, 2, axis=1)
+    # horizontal angle first, so that nothing else is computed for the
+    # points outside the field of view
+    points = np.asarray(points, dtype=np.float32)
+    yaw = -np.arctan2(points[:, 1], points[:, 0])
+    proj_x = (yaw + foh_left) / foh
+    mask = np.logical_and(proj_x >= 0, proj_x <= 1)
+    if not mask.all():
+      points = points[mask]
+      proj_x = proj_x[mask]
 
-    # get scan components
-    scan_x = self.points[:, 0]
-    scan_y = self.points[:, 1]
-    scan_z = self.points[:, 2]
+    # get depth and pitch of the remaining points
+    depth = np.linalg.norm(points, 2, axis=1)
+    pitch = np.arcsin(points[:, 2] / depth)
+    proj_y = 1.0 - (pitch + abs(fov_down)) / fov        # in [0.0, 1.0]
 
-    # get angles of all points
-    yaw = -np.arctan2(scan_y, scan_x)
-    pitch = np.arcsin(scan_z / depth)
+    # scale to image size, round and clamp for use as index
+    proj_x = np.clip(np.floor(proj_x * self.proj_W), 0, self.proj_W - 1).astype(np.int32)   # in [0,W-1]
+    proj_y = np.clip(np.floor(proj_y * self.proj_H), 0, self.proj_H - 1).astype(np.int32)   # in [0,H-1]
+    return mask, proj_x, proj_y, depth
 
-    # get projections in image coords
-    # proj_x = 0.5 * (yaw / np.pi + 1.0)          # in [0.0, 1.0]
-    proj_x  = (yaw + foh_left)/foh
-    proj_y = 1.0 - (pitch + abs(fov_down)) / fov        # in [0.0, 1.0]
-    mask = np.logical_and(proj_x >= 0, proj_x <= 1)
+  def do_range_projection(self):
+    """ Project a pointcloud into a spherical projection image.projection.
+        Function takes no arguments because it can be also called externally
+        if the value of the constructor was not set (in case you change your
+        mind about wanting the projection)
+    """
+    mask, proj_x, proj_y, depth = self.image_coords(self.points)
     self.foh_mask = mask
-    self.points = self.points[mask]
-    self.remissions = self.remissions[mask]
-    if self.points_rgb is not None:
-      self.points_rgb = self.points_rgb[mask]
-    depth = depth[mask]
-    proj_x = proj_x[mask]
-    proj_y = proj_y[mask]
-    
-    
-
-    # scale to image size using angular resolution
-    proj_x *= self.proj_W                              # in [0.0, W]
-    proj_y *= self.proj_H                              # in [0.0, H]
-
-    # round and clamp for use as index
-    proj_x = np.floor(proj_x)
-    proj_x = np.minimum(self.proj_W - 1, proj_x)
-    proj_x = np.maximum(0, proj_x).astype(np.int32)   # in [0,W-1]
-    self.proj_x = np.copy(proj_x)  # store a copy in orig order
-
-    proj_y = np.floor(proj_y)
-    proj_y = np.minimum(self.proj_H - 1, proj_y)
-    proj_y = np.maximum(0, proj_y).astype(np.int32)   # in [0,H-1]
-    self.proj_y = np.copy(proj_y)  # stope a copy in original order
-
-    # copy of depth in original order
-    self.unproj_range = np.copy(depth)
-    # order in decreasing depth
-    indices = np.arange(depth.shape[0])
-    order = np.argsort(depth)[::-1]
-    depth = depth[order]
-    indices = indices[order]
-    points = self.points[order]
-    remission = self.remissions[order]
-  
-    points_rgb = self.points_rgb[order] if self.points_rgb is not None else None
-    proj_y = proj_y[order]
-    proj_x = proj_x[order]
+    if not mask.all():
+      self.points = self.points[mask]
+      self.remissions = self.remissions[mask]
+      if self.points_rgb is not None:
+        self.points_rgb = self.points_rgb[mask]
+    self.proj_x = proj_x
+    self.proj_y = proj_y
+    self.unproj_range = depth
+
+    # nearest point of every pixel, without sorting the scan
+    proj_idx = self.proj_idx.reshape(-1)
+    proj_idx.fill(-1)
+    nearest_index(proj_y * self.proj_W + proj_x, depth, proj_idx, self.proj_nearest)
+    hit = np.flatnonzero(proj_idx >= 0)
+    idx = proj_idx[hit]
 
     # assing to images
-    self.proj_range[proj_y, proj_x] = depth
-    self.proj_xyz[proj_y, proj_x] = points
-    self.proj_remission[proj_y, proj_x] = remission
-    if points_rgb is not None:
-      self.proj_points_rgb[proj_y, proj_x] = points_rgb
-    self.proj_idx[proj_y, proj_x] = indices
-    self.proj_mask = (self.proj_idx >= 0).astype(np.int32)
-    
-    
+    self.proj_range.reshape(-1)[hit] = depth[idx]
+    self.proj_xyz.reshape(-1, 3)[hit] = self.points[idx]
+    self.proj_remission.reshape(-1)[hit] = self.remissions[idx]
+    if self.points_rgb is not None:
+      self.proj_points_rgb.reshape(-1, 3)[hit] = self.points_rgb[idx]
+    self.proj_mask[...] = self.proj_idx >= 0
+
+  def project_batch(self, scans, remissions=None):
+    """ Project a list of [m, 3] scans in one go.
+        Returns a dict with the stacked [B,H,W] proj_range, proj_remission,
+        proj_idx and proj_mask and [B,H,W,3] proj_xyz, and with per scan
+        lists of points, remissions, unproj_range, proj_x, proj_y and
+        foh_mask, like the members filled by do_range_projection. The
+        buffers of this scan are left untouched.
+    """
+    B, H, W = len(scans), self.proj_H, self.proj_W
+    lengths = [len(s) for s in scans]
+    points = np.concatenate([np.asarray(s, dtype=np.float32)[:, :3] for s in scans])
+    if remissions is not None:
+      remission = np.concatenate(remissions).astype(np.float32, copy=False)
+    else:
+      remission = np.zeros(len(points), dtype=np.float32)
+    mask, proj_x, proj_y, depth = self.image_coords(points)
+    points, remission = points[mask], remission[mask]
+    batch = np.repeat(np.arange(B), lengths)[mask]
+
+    proj_idx = np.full(B * H * W, -1, dtype=np.int32)
+    nearest_index((batch * H + proj_y) * W + proj_x, depth, proj_idx,
+                  np.empty(B * H * W, dtype=np.float32))
+    hit = np.flatnonzero(proj_idx >= 0)
+    idx = proj_idx[hit]
+    out = {
+      'proj_range': np.full(B * H * W, -1, dtype=np.float32),
+      'proj_xyz': np.full((B * H * W, 3), -1, dtype=np.float32),
+      'proj_remission': np.full(B * H * W, -1, dtype=np.float32),
+    }
+    out['proj_range'][hit] = depth[idx]
+    out['proj_xyz'][hit] = points[idx]
+    out['proj_remission'][hit] = remission[idx]
+    out = {k: v.reshape((B, H, W) + v.shape[1:]) for k, v in out.items()}
+
+    # per scan: indices into the in-view points of that scan
+    kept = np.bincount(batch, minlength=B)
+    offsets = np.concatenate([[0], np.cumsum(kept)])
+    proj_idx[hit] -= offsets[hit // (H * W)].astype(np.int32)
+    out['proj_idx'] = proj_idx.reshape(B, H, W)
+    out['proj_mask'] = (out['proj_idx'] >= 0).astype(np.int32)
+    split = lambda x: np.split(x, offsets[1:-1])
+    out.update(points=split(points), remissions=split(remission), unproj_range=split(depth),
+               proj_x=split(proj_x), proj_y=split(proj_y), foh_mask=np.split(mask, np.cumsum(lengths)[:-1]))
+    return out
+
+
+def nearest_index(flat, depth, proj_idx, nearest):
+  """ Fill proj_idx (flattened, -1 for empty pixels) with the index of the
+      nearest point of every pixel. flat is the flattened pixel of every
+      point and nearest a float32 scratch buffer the size of proj_idx.
+  """
+  nearest.fill(np.inf)
+  np.minimum.at(nearest, flat, depth)
+  win = np.flatnonzero(depth == nearest[flat])
+  np.maximum.at(proj_idx, flat[win], win.astype(proj_idx.dtype))
+  return proj_idx
+
 
 class SemLaserScan(LaserScan):
   """Class that contains LaserScan with x,y,z,r,sem_label,sem_color_label,inst_label,inst_color_label"""
@@ -226,6 +278,21 @@ class SemLaserScan(LaserScan):
     # force zero to a gray-ish color
     self.inst_color_lut[0] = np.full((3), 0.1)
 
+  def alloc(self):
+    """ Allocate the projection buffers, reset() refills them in place. """
+    super(SemLaserScan, self).alloc()
+    # projection color with semantic labels
+    self.proj_sem_label = np.empty((self.proj_H, self.proj_W),
+                                   dtype=np.int32)              # [H,W]  label
+    self.proj_sem_color = np.empty((self.proj_H, self.proj_W, 3),
+                                   dtype=np.float32)            # [H,W,3] color
+
+    # projection color with instance labels
+    self.proj_inst_label = np.empty((self.proj_H, self.proj_W),
+                                    dtype=np.int32)              # [H,W]  label
+    self.proj_inst_color = np.empty((self.proj_H, self.proj_W, 3),
+                                    dtype=np.float32)            # [H,W,3] color
+
   def reset(self):
     """ Reset scan members. """
     super(SemLaserScan, self).reset()
@@ -237,17 +304,10 @@ class SemLaserScan(LaserScan):
     self.inst_label = np.zeros((0, 1), dtype=np.int32)          # [m, 1]: label
     self.inst_label_color = np.zeros((0, 3), dtype=np.float32)  # [m ,3]: color
 
-    # projection color with semantic labels
-    self.proj_sem_label = np.zeros((self.proj_H, self.proj_W),
-                                   dtype=np.int32)              # [H,W]  label
-    self.proj_sem_color = np.zeros((self.proj_H, self.proj_W, 3),
-                                   dtype=np.float)              # [H,W,3] color
-
-    # projection color with instance labels
-    self.proj_inst_label = np.zeros((self.proj_H, self.proj_W),
-                                    dtype=np.int32)              # [H,W]  label
-    self.proj_inst_color = np.zeros((self.proj_H, self.proj_W, 3),
-                                    dtype=np.float)              # [H,W,3] color
+    self.proj_sem_label.fill(0)
+    self.proj_sem_color.fill(0)
+    self.proj_inst_label.fill(0)
+    self.proj_inst_color.fill(0)
 
   def open_label(self, filename):
     """ Open raw scan and fill in attributes
@@ -312,4 +372,25 @@ class SemLaserScan(LaserScan):
     self.proj_inst_label[mask] = self.inst_label[self.proj_idx[mask]]
     self.proj_inst_color[mask] = self.inst_color_lut[self.inst_label[self.proj_idx[mask]]]
 
+  def project_batch(self, scans, remissions=None, labels=None):
+    """ LaserScan.project_batch, plus the per scan sem_label and inst_label
+        and the stacked [B,H,W] proj_sem_label and proj_inst_label when the
+        raw labels of the scans are given.
+    """
+    out = super(SemLaserScan, self).project_batch(scans, remissions)
+    if labels is None:
+      return out
+    label = np.concatenate([l.reshape(-1)[m] for l, m in zip(labels, out['foh_mask'])])
+    sem_label, inst_label = label & 0xFFFF, label >> 16
+    offsets = np.cumsum([0] + [len(p) for p in out['points'][:-1]])
+    mask = out['proj_idx'] >= 0
+    idx = (out['proj_idx'] + offsets[:, None, None].astype(np.int32))[mask]
+    out['proj_sem_label'] = np.zeros(mask.shape, dtype=np.int32)
+    out['proj_sem_label'][mask] = sem_label[idx]
+    out['proj_inst_label'] = np.zeros(mask.shape, dtype=np.int32)
+    out['proj_inst_label'][mask] = inst_label[idx]
+    out['sem_label'] = np.split(sem_label, offsets[1:])
+    out['inst_label'] = np.split(inst_label, offsets[1:])
+    return out
+
   
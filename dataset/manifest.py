@@ -0,0 +1,142 @@
+import os
+import os.path as osp
+from glob import glob
+
+import numpy as np
+
+FIELDS = ('path', 'seq', 'frame', 'size', 'num_points', 'mtime')
+
+
+def frame_id(path):
+    stem = osp.splitext(osp.basename(path))[0]
+    return int(stem) if stem.isdigit() else -1
+
+
+def scan_dir(seq, directory, pattern, point_dim):
+    # point_dim None: not point clouds (labels, images), num_points is -1
+    paths = sorted(glob(osp.join(directory, pattern)))
+    stats = [os.stat(p) for p in paths]
+    num_points = []
+    for p, st in zip(paths, stats):
+        if point_dim is None:
+            num_points.append(-1)
+        elif p.endswith('.npy'):
+            # projected range image: one slot per pixel, read from the header only
+            num_points.append(int(np.prod(np.load(p, mmap_mode='r').shape[:-1])))
+        else:
+            num_points.append(st.st_size // (4 * point_dim))
+    return {
+        'path': np.array(paths, dtype=str),
+        'seq': np.full(len(paths), seq, dtype=np.int64),
+        'frame': np.array([frame_id(p) for p in paths], dtype=np.int64),
+        'size': np.array([st.st_size for st in stats], dtype=np.int64),
+        'num_points': np.array(num_points, dtype=np.int64),
+        'mtime': np.array([st.st_mtime_ns for st in stats], dtype=np.int64),
+    }
+
+
+def file_stamp(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+class Manifest():
+    """Flat index of the frames of a dataset root.
+
+    Holds path, sequence/frame id, byte size, point count and mtime of every
+    frame as parallel arrays, so that datasets can be built without walking
+    the directory tree, and frames looked up by (seq, frame) in O(1).
+    """
+
+    def __init__(self, entries):
+        self.entries = entries
+        self._frame_index = None
+
+    def __len__(self):
+        return len(self.entries['seq'])
+
+    def __getattr__(self, name):
+        if name in FIELDS:
+            return self.entries[name]
+        raise AttributeError(name)
+
+    def __getstate__(self):
+        return {'entries': self.entries, '_frame_index': None}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    @property
+    def frame_index(self):
+        if self._frame_index is None:
+            self._frame_index = {(int(s), int(f)): i for i, (s, f) in enumerate(zip(self.entries['seq'], self.entries['frame']))}
+        return self._frame_index
+
+    def index_of(self, seq, frame):
+        return self.frame_index[(int(seq), int(frame))]
+
+    def select(self, seqs):
+        # keep the order in which the sequences are requested
+        seq = self.entries['seq']
+        idx = np.concatenate([np.flatnonzero(seq == int(s)) for s in seqs]) if len(seqs) else np.zeros(0, dtype=np.int64)
+        return Manifest({k: v[idx] for k, v in self.entries.items()})
+
+
+def load_manifest(cache_path, seq_dirs, pattern='*', point_dim=4, verify=False):
+    """Load the manifest at cache_path, rescanning only stale sequences.
+
+    seq_dirs maps a sequence id to the directory holding its frames. A
+    sequence is rescanned when it is missing from the manifest or when the
+    path or mtime of its directory changed (files added or removed). Files
+    rewritten in place leave the directory mtime as it is; with verify=True
+    the size and mtime of every file are compared too, at the cost of one
+    stat per frame. point_dim is the number of float32 values per point of
+    the scans, None for files that are not point clouds.
+    """
+    entries, dir_stamps = None, {}
+    stored_dim = -1 if point_dim is None else point_dim
+    if osp.exists(cache_path):
+        with np.load(cache_path) as f:
+            # manifests written with another point_dim have wrong point counts, rebuild them
+            if 'point_dim' in f and int(f['point_dim']) == stored_dim:
+                entries = {k: f[k] for k in FIELDS}
+                dir_stamps = {s: (d, m) for s, d, m in zip(f['dir_seq'].tolist(), f['dir_path'].tolist(), f['dir_mtime'].tolist())}
+
+    stale = {}
+    for seq, directory in seq_dirs.items():
+        mtime = os.stat(directory).st_mtime_ns if osp.isdir(directory) else -1
+        if dir_stamps.get(int(seq)) != (directory, mtime):
+            stale[int(seq)] = (directory, mtime)
+    if verify and entries is not None:
+        for seq in set(int(s) for s in seq_dirs) - set(stale):
+            idx = np.flatnonzero(entries['seq'] == seq)
+            stamps = zip(entries['path'][idx].tolist(), entries['size'][idx].tolist(), entries['mtime'][idx].tolist())
+            if any(file_stamp(p) != (size, mtime) for p, size, mtime in stamps):
+                stale[seq] = dir_stamps[seq]
+    if entries is not None and len(stale) == 0:
+        return Manifest(entries)
+
+    parts = []
+    if entries is not None:
+        keep = ~np.isin(entries['seq'], list(stale.keys()))
+        parts.append({k: v[keep] for k, v in entries.items()})
+    for seq, (directory, mtime) in stale.items():
+        parts.append(scan_dir(seq, directory, pattern, point_dim))
+        dir_stamps[seq] = (directory, mtime)
+    entries = {k: np.concatenate([p[k] for p in parts]) for k in FIELDS}
+    order = np.lexsort((entries['path'], entries['seq']))
+    entries = {k: v[order] for k, v in entries.items()}
+
+    try:
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path, point_dim=np.int64(stored_dim), dir_seq=np.array(list(dir_stamps.keys()), dtype=np.int64),
+                 dir_path=np.array([d for d, _ in dir_stamps.values()], dtype=str),
+                 dir_mtime=np.array([m for _, m in dir_stamps.values()], dtype=np.int64), **entries)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        # read-only dataset roots still work, they just rescan every time
+        print(f'could not write manifest {cache_path}: {e}')
+    return Manifest(entries)
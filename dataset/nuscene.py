@@ -13,6 +13,8 @@ from util import _map
 from PIL import Image
 from scipy import ndimage as nd
 from nuscenes.nuscenes import NuScenes
+from dataset.batch_transform import BatchTransform
+from dataset.manifest import load_manifest
 import pathlib
 
 
@@ -30,7 +32,8 @@ class NuScene(torch.utils.data.Dataset):
         modality=("depth"),
         is_sorted=True,
         is_raw=True,
-        fill_in_label=False):
+        fill_in_label=False,
+        batch_transform=False):
 
       super().__init__()
       self.root = root if is_raw else osp.join(root, 'samples', 'LIDAR_TOP')
@@ -47,6 +50,8 @@ class NuScene(torch.utils.data.Dataset):
       self.is_raw = is_raw
       self.DATA = DATA
       self.fill_in_label = fill_in_label
+      self.batch_transform = BatchTransform(self.shape, self.flip) if batch_transform else None
+      self.collate_fn = self.batch_transform.collate if batch_transform else None
       self.nusc = NuScenes(version = 'v1.0-mini', dataroot = root) if is_raw else None
       self.load_datalist()
 
@@ -67,8 +72,8 @@ class NuScene(torch.utils.data.Dataset):
                 datalist.append(sample_path)
                 labels_list.append(label_path)
         else:
-            datalist = list(sorted(glob(osp.join(self.root, "PCL/*.npy"))))
-            labels_list = list(sorted(glob(osp.join(self.root, "label/*.png"))))
+            datalist = load_manifest(osp.join(self.root, 'manifest.npz'), {0: osp.join(self.root, 'PCL')}, '*.npy', point_dim=4).path.tolist()
+            labels_list = load_manifest(osp.join(self.root, 'label_manifest.npz'), {0: osp.join(self.root, 'label')}, '*.png', point_dim=None).path.tolist()
         if self.split == 'train':
             split_idx = range(int(len(datalist) * 0.9))
         else:
@@ -107,6 +112,13 @@ class NuScene(torch.utils.data.Dataset):
         return out
 
     def __getitem__(self, index):
+        out = self.preprocess(self.load_frame(index))
+        if self.batch_transform is None:
+            out = self.transform(out)
+        return out
+
+    def load_frame(self, index):
+        # decoded modalities of one frame, before fill-in and normalisation
         points_path = self.datalist[index]
         labels_path = self.labels_list[index]
         if not self.is_raw:
@@ -117,16 +129,17 @@ class NuScene(torch.utils.data.Dataset):
             point_cloud = np.fromfile(points_path, dtype=np.float32).reshape((-1, 5))
             point_cloud = point_cloud[:, [1, 0, 2, 3]]; point_cloud[:, 0] = -point_cloud[:, 0]
             sem_label = np.fromfile(labels_path, dtype=np.uint8)
+            # projection of the dataset config, the nuScenes 32-beam defaults without one
+            H, W = getattr(self.DATA, 'height', 32), getattr(self.DATA, 'width', 1024)
+            fov_up, fov_down = getattr(self.DATA, 'fov_up', 10.0), getattr(self.DATA, 'fov_down', -30.0)
             points, _ = point_cloud_to_xyz_image(np.concatenate([point_cloud, sem_label.astype('float32')[:, None]], axis=1) \
-              , H=32, W=1024,fov_up=10.0, fov_down=-30.0, is_sorted=self.is_sorted)
+              , H=H, W=W, fov_up=fov_up, fov_down=fov_down, is_sorted=self.is_sorted)
         out = {}
         out["points"] = points[..., :3]
         if "reflectance" in self.modality:
             out["reflectance"] = points[..., [3]] / 255.0
         if "label" in self.modality:
             out["label"] = points[..., [4]]
-        out = self.preprocess(out)
-        out = self.transform(out)
         return out
 
     def __len__(self):
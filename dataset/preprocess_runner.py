@@ -0,0 +1,117 @@
+import hashlib
+import os
+import os.path as osp
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from tqdm import tqdm
+
+
+def atomic_write(path, write):
+    """Calls write(f) on a temporary file next to path, then renames it over path.
+
+    Readers (and a resumed run) never see a half written output.
+    """
+    os.makedirs(osp.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    finally:
+        if osp.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class Ledger():
+    """Append-only list of finished task keys, one per line.
+
+    With a config, the ledger file name carries a fingerprint of it, so a
+    run with other settings (resolution, FOV, calibration, ...) starts from
+    an empty ledger instead of skipping outputs made with the old ones.
+    """
+
+    def __init__(self, path, config=None):
+        if config is not None:
+            fingerprint = hashlib.md5('|'.join(f'{k}={v}' for k, v in sorted(config.items())).encode()).hexdigest()[:12]
+            root, ext = osp.splitext(path)
+            path = f'{root}.{fingerprint}{ext}'
+        self.path = path
+        self.done = set()
+        if osp.exists(path):
+            with open(path, 'r') as f:
+                # a line cut by a crash matches no key and is simply redone
+                self.done = set(f.read().splitlines())
+        os.makedirs(osp.dirname(osp.abspath(path)), exist_ok=True)
+        self.file = open(path, 'a')
+
+    def __contains__(self, key):
+        return key in self.done
+
+    def mark(self, keys):
+        if not keys:
+            return
+        self.file.write(''.join(f'{k}\n' for k in keys))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.done.update(keys)
+
+    def close(self):
+        self.file.close()
+
+
+def run_batch(fn, batch):
+    done, failed = [], []
+    for key, args in batch:
+        try:
+            fn(*args)
+            done.append(key)
+        except Exception as e:
+            failed.append((key, repr(e)))
+    return done, failed
+
+
+def run_tasks(fn, tasks, ledger_path, num_workers=None, batch_size=16, max_pending=None, desc='preprocess',
+              config=None, outputs=None):
+    """Runs fn(*args) for every (key, args) in tasks in a process pool.
+
+    Tasks already recorded in the ledger of this config are skipped, so an
+    interrupted run picks up where it stopped. outputs(key) lists the files
+    a task writes; a recorded task whose outputs are missing is redone.
+    Workers get batches of batch_size tasks and at most max_pending batches
+    (2 per worker by default) are submitted at any time, so the task list
+    is never materialised in the pool. A batch is recorded in the ledger
+    once all of its tasks returned; failed tasks are reported and left out
+    of the ledger to be retried by the next run.
+    """
+    num_workers = num_workers or os.cpu_count() or 1
+    max_pending = max_pending or 2 * num_workers
+    ledger = Ledger(ledger_path, config)
+    is_done = lambda key: key in ledger and (outputs is None or all(osp.exists(p) for p in outputs(key)))
+    tasks = [(key, args) for key, args in tasks if not is_done(key)]
+    batches = (tasks[i:i + batch_size] for i in range(0, len(tasks), batch_size))
+    print(f'{desc}: {len(ledger.done)} done, {len(tasks)} to go')
+    failures = []
+    pbar = tqdm(total=len(tasks), desc=desc, unit='file', smoothing=0.05)
+    try:
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            pending = set()
+            for batch in batches:
+                pending.add(pool.submit(run_batch, fn, batch))
+                if len(pending) >= max_pending:
+                    break
+            while pending:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    done, failed = future.result()
+                    ledger.mark(done)
+                    failures.extend(failed)
+                    pbar.update(len(done) + len(failed))
+                    batch = next(batches, None)
+                    if batch is not None:
+                        pending.add(pool.submit(run_batch, fn, batch))
+    finally:
+        pbar.close()
+        ledger.close()
+    for key, err in failures:
+        print(f'{desc}: failed {key}: {err}')
+    return failures
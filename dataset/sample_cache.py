@@ -0,0 +1,94 @@
+import fcntl
+import hashlib
+import os
+import os.path as osp
+import pickle
+
+import numpy as np
+
+DEFAULT_DIR = '/dev/shm/coligen_sample_cache'
+
+
+class SharedSampleCache():
+    """LRU cache of preprocessed samples kept in shared memory (tmpfs).
+
+    Each entry is one file under `cache_dir`, which lives on /dev/shm by
+    default, so every worker of every DataLoader in the process tree (and
+    any other run on the same machine with the same preprocessing config)
+    reads the same entries. Hits refresh the entry mtime. Once the total
+    size goes over `budget_bytes`, the least recently used entries are
+    evicted under a file lock.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_DIR, budget_bytes=8 * 1024 ** 3, config=None):
+        self.cache_dir = cache_dir
+        self.budget_bytes = budget_bytes
+        self.config = '|'.join(f'{k}={v}' for k, v in sorted((config or {}).items()))
+        self.lock_path = osp.join(cache_dir, '.lock')
+        # bytes this process wrote since it last checked the budget
+        self._written = budget_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, src_path, *stat_paths):
+        # mtimes of every file the sample is read from, src_path by default
+        mtimes = ','.join(str(os.stat(p).st_mtime_ns) for p in stat_paths or (src_path,))
+        return hashlib.md5(f'{src_path}|{mtimes}|{self.config}'.encode()).hexdigest()
+
+    def get(self, key):
+        path = osp.join(self.cache_dir, key + '.pkl')
+        try:
+            with open(path, 'rb') as f:
+                out = pickle.load(f)
+            os.utime(path)
+            return out
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            # missing, evicted meanwhile or half written by a killed worker
+            return None
+
+    def put(self, key, out):
+        path = osp.join(self.cache_dir, key + '.pkl')
+        data = pickle.dumps({k: np.ascontiguousarray(v) if isinstance(v, np.ndarray) else v for k, v in out.items()},
+                            protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.budget_bytes:
+            return
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            # tmpfs full: drop the entry rather than failing the batch
+            if osp.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        # scanning the directory is not free, only do it every ~5% of the budget
+        self._written += len(data)
+        if self._written >= 0.05 * self.budget_bytes:
+            self._written = 0
+            self.evict()
+
+    def evict(self):
+        with open(self.lock_path, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = []
+            total = 0
+            for e in os.scandir(self.cache_dir):
+                if not e.name.endswith('.pkl'):
+                    continue
+                try:
+                    st = e.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, e.path))
+                total += st.st_size
+            if total <= self.budget_bytes:
+                return
+            # evict down to 90% of the budget so that the next puts do not evict again
+            for _, size, path in sorted(entries):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                if total <= 0.9 * self.budget_bytes:
+                    break
@@ -0,0 +1,122 @@
+import os
+import os.path as osp
+from glob import glob
+
+import numpy as np
+import yaml
+from PIL import Image
+
+# one shard per sequence: sequences/XX/shard/{records.bin, index.npy, meta.yml}
+SHARD_DIR = 'shard'
+RECORDS_FILE = 'records.bin'
+INDEX_FILE = 'index.npy'
+META_FILE = 'meta.yml'
+
+index_dtype = np.dtype([('frame', '<i8'), ('offset', '<i8')])
+
+
+def record_dtype(H, W):
+    # fixed-stride record, every field is a (H, W[, C]) image
+    return np.dtype([
+        ('points', '<f4', (H, W, 3)),
+        ('reflectance', '<f4', (H, W, 1)),
+        ('label', 'u1', (H, W)),
+        ('mask', '?', (H, W)),
+    ])
+
+
+def shard_dir(seq_dir):
+    return osp.join(seq_dir, SHARD_DIR)
+
+
+def has_shard(seq_dir):
+    return osp.exists(osp.join(shard_dir(seq_dir), META_FILE))
+
+
+class SequenceShard():
+    """Read-side view of a packed sequence.
+
+    Records are memory-mapped copy-on-write, so each field returned by
+    __getitem__ is a numpy view into the page cache that the dataset can
+    normalise in place without touching the file.
+    """
+
+    def __init__(self, seq_dir):
+        root = shard_dir(seq_dir)
+        meta = yaml.safe_load(open(osp.join(root, META_FILE), 'r'))
+        self.H, self.W = meta['height'], meta['width']
+        self.has_label = meta['has_label']
+        self.dtype = record_dtype(self.H, self.W)
+        self.index = np.load(osp.join(root, INDEX_FILE))
+        self.records_path = osp.join(root, RECORDS_FILE)
+        self.frame_to_pos = {int(f): i for i, f in enumerate(self.index['frame'])}
+        # opened lazily so that the dataset can be pickled into workers
+        self._records = None
+
+    @property
+    def records(self):
+        if self._records is None:
+            self._records = np.memmap(self.records_path, dtype=self.dtype, mode='c')
+        return self._records
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_records'] = None
+        return state
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, pos):
+        # offsets are fixed-stride today, the index keeps the format open to
+        # variable sized records
+        rec = self.records[int(self.index['offset'][pos]) // self.dtype.itemsize]
+        return {k: rec[k] for k in self.dtype.names}
+
+
+def write_sequence_shard(seq_dir):
+    """Pack a projected/ sequence (velodyne/*.npy, labels/*.png) into a shard."""
+    point_paths = sorted(glob(osp.join(seq_dir, 'velodyne', '*.npy')))
+    if len(point_paths) == 0:
+        return 0
+    H, W = np.load(point_paths[0], mmap_mode='r').shape[:2]
+    label_paths = [p.replace('velodyne', 'labels').replace('npy', 'png') for p in point_paths]
+    num_labels = sum(osp.exists(p) for p in label_paths)
+    if 0 < num_labels < len(label_paths):
+        raise FileNotFoundError(f'{seq_dir}: {len(label_paths) - num_labels} of {len(label_paths)} frames have no label file')
+    has_label = num_labels > 0
+    dtype = record_dtype(H, W)
+    root = shard_dir(seq_dir)
+    os.makedirs(root, exist_ok=True)
+
+    index = np.zeros(len(point_paths), dtype=index_dtype)
+    tmp_path = osp.join(root, RECORDS_FILE + '.tmp')
+    records = np.memmap(tmp_path, dtype=dtype, mode='w+', shape=(len(point_paths),))
+    for i, point_path in enumerate(point_paths):
+        points = np.load(point_path).astype(np.float32)
+        rec = records[i]
+        rec['points'] = points[..., :3]
+        rec['reflectance'] = points[..., 3:4]
+        rec['mask'] = np.linalg.norm(points[..., :3], ord=2, axis=2) > 0.0
+        if has_label:
+            rec['label'] = np.array(Image.open(label_paths[i]))
+        index[i] = (int(osp.splitext(osp.basename(point_path))[0]), i * dtype.itemsize)
+    records.flush()
+    del records
+    os.replace(tmp_path, osp.join(root, RECORDS_FILE))
+    np.save(osp.join(root, INDEX_FILE), index)
+    meta = {'height': int(H), 'width': int(W), 'has_label': bool(has_label), 'num_frames': len(point_paths)}
+    with open(osp.join(root, META_FILE), 'w') as f:
+        yaml.safe_dump(meta, f)
+    return len(point_paths)
+
+
+def convert_projected_to_shards(projected_root):
+    """Convert every sequence under <projected_root>/sequences to the shard format."""
+    seq_dirs = sorted(glob(osp.join(projected_root, 'sequences', '*')))
+    total = 0
+    for seq_dir in seq_dirs:
+        n = write_sequence_shard(seq_dir)
+        print(f'{seq_dir}: packed {n} frames')
+        total += n
+    return total
@@ -0,0 +1,177 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import torch
+import yaml
+from tqdm import tqdm
+
+CHANNELS = ('depth', 'x', 'y', 'z', 'reflectance')
+
+# dataset of the worker process, sent once by the pool initializer
+_dataset = None
+
+
+class RunningMoments():
+    """Per-channel count/mean/M2/min/max, merged with Chan et al.'s parallel Welford update."""
+
+    def __init__(self, n_channels):
+        self.count = 0
+        self.mean = np.zeros(n_channels)
+        self.m2 = np.zeros(n_channels)
+        self.min = np.full(n_channels, np.inf)
+        self.max = np.full(n_channels, -np.inf)
+
+    def merge_moments(self, count, mean, m2, vmin, vmax):
+        if count == 0:
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / total
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * count / total
+        self.count = total
+        self.min = np.minimum(self.min, vmin)
+        self.max = np.maximum(self.max, vmax)
+
+    def update(self, x):
+        # x: (N, C) samples of one frame
+        if len(x) == 0:
+            return
+        x = x.astype(np.float64)
+        mean = x.mean(axis=0)
+        self.merge_moments(len(x), mean, ((x - mean) ** 2).sum(axis=0), x.min(axis=0), x.max(axis=0))
+
+    def merge(self, other):
+        self.merge_moments(other.count, other.mean, other.m2, other.min, other.max)
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / max(self.count, 1))
+
+
+class DatasetStatistics():
+    """Mergeable statistics of the valid pixels of range image frames.
+
+    Accumulates per-channel moments of depth/x/y/z and, for datasets that
+    have it, reflectance, the per-pixel pitch and yaw sums behind angles.pt
+    and a per-class label histogram. All state is sums or moments, so partial
+    results of workers merge exactly.
+    """
+
+    def __init__(self, shape, n_classes=0):
+        H, W = shape
+        self.n_frames = 0
+        self.moments = RunningMoments(len(CHANNELS) - 1)
+        self.reflectance = RunningMoments(1)
+        self.valid = np.zeros((H, W))
+        self.pitch = np.zeros((H, W))
+        self.yaw = np.zeros((H, W))
+        self.hist = np.zeros(n_classes, dtype=np.int64)
+
+    def update(self, points, valid, reflectance=None, label=None):
+        # points (H, W, 3) in metres, valid (H, W) bool, reflectance/label (H, W[, 1])
+        x, y, z = points[..., 0], points[..., 1], points[..., 2]
+        depth = np.linalg.norm(points, ord=2, axis=2)
+        self.n_frames += 1
+        self.valid += valid
+        self.pitch += np.where(valid, np.arctan2(z, np.sqrt(x ** 2 + y ** 2)), 0)
+        self.yaw += np.where(valid, np.arctan2(y, x), 0)
+        self.moments.update(np.stack([depth, x, y, z], axis=-1)[valid])
+        if reflectance is not None:
+            self.reflectance.update(reflectance.reshape(depth.shape)[valid][:, None])
+        if label is not None:
+            label = label.reshape(depth.shape)[valid].astype(np.int64)
+            hist = np.bincount(label, minlength=len(self.hist))
+            if len(hist) > len(self.hist):
+                self.hist = np.pad(self.hist, (0, len(hist) - len(self.hist)))
+            self.hist += hist
+
+    def merge(self, other):
+        self.n_frames += other.n_frames
+        self.moments.merge(other.moments)
+        self.reflectance.merge(other.reflectance)
+        self.valid += other.valid
+        self.pitch += other.pitch
+        self.yaw += other.yaw
+        n = max(len(self.hist), len(other.hist))
+        self.hist = np.pad(self.hist, (0, n - len(self.hist))) + np.pad(other.hist, (0, n - len(other.hist)))
+        return self
+
+    def angles(self):
+        """(2, H, W) mean pitch/yaw of every pixel and the valid ratio of every pixel.
+
+        Pixels that never had a return fall back to the mean pitch of their
+        row and the mean yaw of their column.
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            pitch = self.pitch / self.valid
+            yaw = self.yaw / self.valid
+        mean_pitch = np.broadcast_to(np.nanmean(pitch, axis=1, keepdims=True), pitch.shape)
+        mean_yaw = np.broadcast_to(np.nanmean(yaw, axis=0, keepdims=True), yaw.shape)
+        has_return = self.valid > 0
+        angles = np.stack([np.where(has_return, pitch, mean_pitch), np.where(has_return, yaw, mean_yaw)])
+        return torch.from_numpy(np.nan_to_num(angles)).float(), self.valid / max(self.n_frames, 1)
+
+    def summary(self):
+        total = max(self.hist.sum(), 1)
+        # reflectance is left out, not NaN, for datasets without it
+        moments = [self.moments] + ([self.reflectance] if self.reflectance.count > 0 else [])
+        field = lambda name: np.concatenate([getattr(m, name) for m in moments]).tolist()
+        return {
+            'n_frames': int(self.n_frames),
+            'n_points': int(self.moments.count),
+            'channels': list(CHANNELS[:len(field('mean'))]),
+            'mean': field('mean'),
+            'std': field('std'),
+            'min': field('min'),
+            'max': field('max'),
+            'class_hist': {int(c): int(n) for c, n in enumerate(self.hist) if n > 0},
+            'class_freq': {int(c): float(n / total) for c, n in enumerate(self.hist) if n > 0},
+        }
+
+
+def init_worker(dataset):
+    global _dataset
+    _dataset = dataset
+
+
+def frame_statistics(indices, shape, dataset=None):
+    # streams the frames of one chunk once and returns the partial state
+    dataset = dataset or _dataset
+    stats = DatasetStatistics(shape)
+    for index in indices:
+        out = dataset.load_frame(index)
+        points = out['points']
+        depth = np.linalg.norm(points, ord=2, axis=2)
+        valid = (out['mask'] if 'mask' in out else depth > 0.0) & (depth > dataset.min_depth) & (depth < dataset.max_depth)
+        label = out.get('lwo', out.get('label'))
+        stats.update(points, valid, out.get('reflectance'), label)
+    return stats
+
+
+def compute_statistics(dataset, shape, num_workers=None, chunk_size=64, desc='statistics', indices=None):
+    """Single pass over dataset (any dataset with load_frame) with a process pool.
+
+    indices restricts the pass to a subset of the frames, all by default.
+    """
+    num_workers = num_workers or os.cpu_count() or 1
+    indices = np.arange(len(dataset)) if indices is None else np.asarray(indices)
+    chunks = [indices[s:s + chunk_size] for s in range(0, len(indices), chunk_size)]
+    stats = DatasetStatistics(shape)
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=init_worker, initargs=(dataset,)) as pool, \
+            tqdm(total=len(indices), desc=desc, unit='frame') as pbar:
+        futures = {pool.submit(frame_statistics, chunk, shape): len(chunk) for chunk in chunks}
+        for future in as_completed(futures):
+            stats.merge(future.result())
+            pbar.update(futures[future])
+    return stats
+
+
+def save_statistics(stats, out_dir):
+    angles, mean_valid = stats.angles()
+    torch.save(angles, os.path.join(out_dir, 'angles.pt'))
+    summary = stats.summary()
+    summary['mean_valid'] = float(mean_valid.mean())
+    with open(os.path.join(out_dir, 'stats.yml'), 'w') as f:
+        yaml.safe_dump(summary, f, sort_keys=False)
+    return summary
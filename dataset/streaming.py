@@ -0,0 +1,190 @@
+import multiprocessing as mp
+import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from torch.utils.data import IterableDataset, get_worker_info
+
+
+class StreamingDataset(IterableDataset):
+    """Sequential streaming view over a map-style dataset.
+
+    The index range is cut into contiguous chunks of `chunk_size` frames,
+    which keeps reads within a sequence sequential. Chunk order is shuffled
+    each epoch, chunks are sharded across DataLoader workers, and every
+    worker reads its chunks through a small thread pool with at most
+    `readahead` chunks in flight. Samples then pass through a shuffle buffer
+    of `shuffle_buffer` entries. Random access is delegated to the wrapped
+    dataset, so code that indexes the dataset directly keeps working.
+
+    The epoch set by `set_epoch` lives in shared memory, so persistent
+    workers see it too. Every pass shuffles with the seed and that epoch
+    plus the number of passes made since the last `set_epoch`, so streams
+    that are never given an epoch still change order every pass.
+    """
+
+    def __init__(self, dataset, chunk_size=64, readahead=4, num_threads=2, shuffle_buffer=256, shuffle=True, seed=0):
+        super().__init__()
+        self.dataset = dataset
+        self.chunk_size = chunk_size
+        self.readahead = readahead
+        self.num_threads = num_threads
+        self.shuffle_buffer = shuffle_buffer if shuffle else 0
+        self.shuffle = shuffle
+        self.seed = seed
+        # (epoch, number of set_epoch calls), shared with the DataLoader workers
+        self.shared_epoch = mp.Array('q', 2)
+        self.generation = 0
+        self.passes = 0
+        # (batch_size, num_workers, drop_last) of the loader, see `set_batching`
+        self.batching = None
+        self.collate_fn = getattr(dataset, 'collate_fn', None)
+
+    def __getattr__(self, name):
+        # datalist, index_of, max_depth, ... of the wrapped dataset
+        if name == 'dataset':
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def __len__(self):
+        if self.batching is None:
+            return len(self.dataset)
+        # the DataLoader divides this by the batch size
+        return self.num_batches(*self.batching) * self.batching[0]
+
+    def __getitem__(self, index):
+        return self.dataset[index]
+
+    def set_epoch(self, epoch):
+        with self.shared_epoch.get_lock():
+            self.shared_epoch[0] = epoch
+            self.shared_epoch[1] += 1
+
+    def pass_epoch(self):
+        # epoch of the next pass: the last epoch set plus the passes made since
+        epoch, generation = self.shared_epoch[:]
+        if generation != self.generation:
+            self.generation, self.passes = generation, 0
+        return epoch + self.passes
+
+    def set_batching(self, batch_size, num_workers, drop_last):
+        self.batching = (batch_size, num_workers, drop_last)
+
+    def num_batches(self, batch_size, num_workers, drop_last):
+        """Batches per epoch when every worker batches its own shard.
+
+        Each worker ends on a partial batch (or drops it), so this is less
+        than len(dataset) / batch_size. Computed for the chunk order of the
+        upcoming pass.
+        """
+        chunks = self.epoch_chunks(self.pass_epoch())
+        n_workers = max(1, num_workers)
+        per_worker = [sum(len(c) for c in chunks[w::n_workers]) for w in range(n_workers)]
+        if drop_last:
+            return sum(k // batch_size for k in per_worker)
+        return sum((k + batch_size - 1) // batch_size for k in per_worker)
+
+    def epoch_chunks(self, epoch):
+        n = len(self.dataset)
+        chunks = [range(s, min(s + self.chunk_size, n)) for s in range(0, n, self.chunk_size)]
+        # same seed in every worker so that they agree on the chunk order
+        if self.shuffle:
+            random.Random(self.seed + epoch).shuffle(chunks)
+        return chunks
+
+    def worker_chunks(self, epoch):
+        chunks = self.epoch_chunks(epoch)
+        info = get_worker_info()
+        if info is not None:
+            chunks = chunks[info.id::info.num_workers]
+        return chunks
+
+    def read_chunk(self, chunk):
+        return [self.dataset[i] for i in chunk]
+
+    def iter_samples(self, epoch):
+        chunks = iter(self.worker_chunks(epoch))
+        with ThreadPoolExecutor(max_workers=self.num_threads) as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.submit(self.read_chunk, chunk))
+                if len(pending) >= self.readahead:
+                    break
+            while pending:
+                samples = pending.popleft().result()
+                chunk = next(chunks, None)
+                if chunk is not None:
+                    pending.append(pool.submit(self.read_chunk, chunk))
+                yield from samples
+
+    def __iter__(self):
+        epoch = self.pass_epoch()
+        self.passes += 1
+        samples = self.iter_samples(epoch)
+        if self.shuffle_buffer <= 1:
+            yield from samples
+            return
+        info = get_worker_info()
+        rng = random.Random(self.seed + epoch + (info.id if info is not None else 0))
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            i = rng.randrange(len(buffer))
+            yield buffer[i]
+            buffer[i] = sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+class StreamingBinaryScan(IterableDataset):
+    """Unpaired A/B stream: every A sample is zipped with the next B sample."""
+
+    def __init__(self, stream_A, stream_B, pair):
+        super().__init__()
+        self.stream_A, self.stream_B = stream_A, stream_B
+        # map-style BinaryScan used for random access (e.g. FID statistics)
+        self.pair = pair
+        self.datasetA, self.datasetB = pair.datasetA, pair.datasetB
+
+    def __len__(self):
+        # A drives the epoch
+        return len(self.stream_A) if self.stream_A.batching is not None else len(self.pair)
+
+    def __getitem__(self, index):
+        return self.pair[index]
+
+    def repeat_B(self):
+        # restart the B stream instead of itertools.cycle, which keeps a copy of every sample
+        while True:
+            empty = True
+            for sample in self.stream_B:
+                empty = False
+                yield sample
+            if empty:
+                return
+
+    def __iter__(self):
+        # A drives the epoch, B wraps around when it is the smaller domain
+        for sample_A, sample_B in zip(self.stream_A, self.repeat_B()):
+            yield {'A': sample_A, 'B': sample_B}
+
+    def set_epoch(self, epoch):
+        self.stream_A.set_epoch(epoch)
+        self.stream_B.set_epoch(epoch)
+
+    def set_batching(self, batch_size, num_workers, drop_last):
+        self.stream_A.set_batching(batch_size, num_workers, drop_last)
+
+    def collate_fn(self, samples):
+        return self.pair.collate_fn(samples)
+
+
+def streaming_cfg(cfg):
+    # dataset section `streaming:` may be `true` or a dict of the options below
+    streaming = getattr(cfg, 'streaming', False)
+    if not streaming:
+        return None
+    defaults = {'chunk_size': 64, 'readahead': 4, 'num_threads': 2, 'shuffle_buffer': 256}
+    return {k: getattr(streaming, k, v) for k, v in defaults.items()}
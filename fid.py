@@ -64,6 +64,7 @@ class FID():
     sigma = np.cov(all_activations, rowvar=False)
     return mu, sigma
 
+  @torch.inference_mode()
   def compute_range_net_features(self, data_tensor):
     n_batch = np.ceil(len(data_tensor) / self.batch_size)
     features_list = []
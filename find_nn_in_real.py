@@ -108,13 +108,8 @@ def main(runner_cfg_path=None):
           is_ref_semposs=False
       )
 
-    data_list = sim_dataset.datalist
-    dataset_A_datalist = np.array(data_list)
-    dataset_A_selected_idx = []
     n_sub_sample = min(len(real_dataset), 5000)
-    for seq, id in zip(seqs, ids):
-        pcl_file_path = os.path.join(ds_cfg_A.data_dir, 'sequences', str(seq).zfill(2), 'velodyne', str(id).zfill(6)+('.bin' if ds_cfg_A.is_raw else '.npy'))
-        dataset_A_selected_idx.append(np.where(dataset_A_datalist == pcl_file_path)[0][0])
+    dataset_A_selected_idx = [sim_dataset.index_of(seq, id) for seq, id in zip(seqs, ids)]
     val_tq = tqdm.tqdm(total=len(dataset_A_selected_idx), desc='sim_Iter', position=5)
     for i, idx in enumerate(dataset_A_selected_idx):
         sim_data = sim_dataset[idx]
@@ -199,12 +199,8 @@ def main(runner_cfg_path=None):
 
     is_ref_semposs = cl_args.ref_dataset_name == 'semanticPOSS'
     val_dl, val_dataset = get_data_loader(opt, split, opt.training.batch_size, shuffle=False, is_ref_semposs=is_ref_semposs)
-    data_list = val_dataset.datasetA.datalist if is_two_dataset else val_dataset.datalist
-    dataset_A_datalist = np.array(data_list)
-    dataset_A_selected_idx = []
-    for seq, id in zip(seqs, ids):
-        pcl_file_path = os.path.join(ds_cfg.data_dir, 'sequences', str(seq).zfill(2), 'velodyne', str(id).zfill(6)+('.bin' if ds_cfg.is_raw else '.npy'))
-        dataset_A_selected_idx.append(np.where(dataset_A_datalist == pcl_file_path)[0][0])
+    dataset_A = val_dataset.datasetA if is_two_dataset else val_dataset
+    dataset_A_selected_idx = [dataset_A.index_of(seq, id) for seq, id in zip(seqs, ids)]
     
     # test_dl, test_dataset = get_data_loader(opt, 'test', opt.training.batch_size, dataset_name=cl_args.ref_dataset_name, two_dataset_enabled=False)
     with torch.no_grad():
@@ -1,3 +1,4 @@
+import contextlib
 import os
 import torch
 from collections import OrderedDict
@@ -7,6 +8,7 @@ from util.metrics.cov_mmd_1nna import compute_cd
 from util.metrics.depth import compute_depth_accuracy, compute_depth_error
 from util.util import SSIM
 from util import *
+from util.amp import grad_scaler
 
 class BaseModel(ABC):
     """This class is an abstract base class (ABC) for models.
@@ -64,6 +66,44 @@ class BaseModel(ABC):
         self.image_paths = []
         self.crterionSSIM = SSIM()
         self.metric = 0  # used for learning rate policy 'plateau'
+        # opt-in mixed precision: bfloat16 autocast on CPU, float16 with loss scaling on GPU
+        self.amp = getattr(opt.training, 'amp', False)
+        self.amp_device = 'cuda' if self.gpu_ids and torch.cuda.is_available() else 'cpu'
+        self.amp_dtype = torch.float16 if self.amp_device == 'cuda' else torch.bfloat16
+        self.scalers = {}
+
+    def autocast(self):
+        """Context of the forward passes and losses, a no-op unless training.amp is set."""
+        if not self.amp:
+            return contextlib.nullcontext()
+        return torch.autocast(self.amp_device, dtype=self.amp_dtype)
+
+    def scaler(self, group):
+        # one GradScaler per loss, shared by the optimizers that loss updates; only float16 needs one
+        if group not in self.scalers:
+            self.scalers[group] = grad_scaler()
+        return self.scalers[group]
+
+    def backward(self, loss, group):
+        """loss.backward() outside autocast, with the loss scaled by the GradScaler of group under float16."""
+        if not self.amp:
+            loss.backward()
+            return
+        with torch.autocast(self.amp_device, enabled=False):
+            if self.amp_dtype == torch.float16:
+                loss = self.scaler(group).scale(loss)
+            loss.backward()
+
+    def step(self, group, *optimizers):
+        """Steps the optimizers of group; under float16 skipped on inf/nan gradients, then the scale is updated."""
+        if not (self.amp and self.amp_dtype == torch.float16):
+            for optimizer in optimizers:
+                optimizer.step()
+            return
+        scaler = self.scaler(group)
+        for optimizer in optimizers:
+            scaler.step(optimizer)
+        scaler.update()
 
     @staticmethod
     def modify_commandline_options(parser, is_train):
@@ -180,7 +220,9 @@ class BaseModel(ABC):
         visual_ret = OrderedDict()
         for name in self.visual_names:
             if isinstance(name, str):
-                visual_ret[name] = getattr(self, name)
+                visual = getattr(self, name)
+                # outputs of an autocast forward are half precision
+                visual_ret[name] = visual.float() if torch.is_tensor(visual) and visual.is_floating_point() else visual
         return visual_ret
 
     def get_current_losses(self, is_eval=False):
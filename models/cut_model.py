@@ -48,6 +48,8 @@ class CUTModel(BaseModel):
         self.netG = networks.define_G(input_nc_G, output_nc_G, opt_m.ngf, opt_m.netG, opt_m.normG, not opt_m.no_dropout, opt_m.init_type, opt_m.init_gain, self.gpu_ids, opt_m.out_ch, opt_m.no_antialias, opt_m.no_antialias_up, opt=opt_m, have_cond_mod= len(opt_m.modality_cond) > 0)
         self.netF = networks.define_F(input_nc_G, opt_m.netF, opt_m.normG, not opt_m.no_dropout, opt_m.init_type, opt_m.init_gain,  self.gpu_ids, opt_m.no_antialias, opt_m) if self.opt.model.lambda_NCE > 0.0 else None
         self.netF_feat = networks.define_F(input_nc_G, opt_m.netF, opt_m.normG, not opt_m.no_dropout, opt_m.init_type, opt_m.init_gain,  self.gpu_ids, opt_m.no_antialias, opt_m) if self.opt.model.lambda_NCE_feat > 0.0 else None
+        # batch norm statistics depend on the batch, only encode the NCE inputs together without it
+        self.nce_encode_together = not any(isinstance(m, torch.nn.modules.batchnorm._BatchNorm) for m in self.netG.modules())
         
         if self.isTrain:
             self.netD = networks.define_D(input_nc_D, opt_m.ndf, opt_m.netD, opt_m.n_layers_D, opt_m.normD, opt_m.init_type, opt_m.init_gain, self.gpu_ids, opt_m.no_antialias, opt_m)
@@ -145,7 +147,7 @@ class CUTModel(BaseModel):
 
         # combine loss and calculate gradients
         self.loss_D = (self.loss_D_fake + self.loss_D_real) * 0.5
-        self.loss_D.backward()
+        self.backward(self.loss_D, 'D')
 
     def backward_G(self):
         if self.lidar_B is None : 
@@ -162,7 +164,11 @@ class CUTModel(BaseModel):
         self.loss_NCE_pix, self.loss_NCE_feat, self.loss_NCE_bd = 0.0, 0.0, 0.0
 
         if self.opt.model.lambda_NCE > 0.0:
-            self.loss_NCE_pix = self.calculate_NCE_loss(self.real_A, self.fake_B)
+            nce_pairs = [(self.real_A, self.fake_B)]
+            if self.opt.model.nce_idt:
+                nce_pairs.append((self.real_B_mod_A, self.idt_B))
+            loss_NCE_pix = self.calculate_NCE_losses(nce_pairs)
+            self.loss_NCE_pix = loss_NCE_pix[0]
         if self.opt.model.lambda_NCE_feat > 0.0:
             src_vol = prepare_data_for_seg(self.data_A, self.lidar_A)
             tgt_vol = prepare_synth_for_seg(self, self.lidar_B)
@@ -171,7 +177,7 @@ class CUTModel(BaseModel):
         loss_NCE_both_pix, loss_NCE_both_feat = self.loss_NCE_pix, self.loss_NCE_feat
 
         if self.opt.model.nce_idt and self.opt.model.lambda_NCE > 0.0:
-            self.loss_NCE_Y_pix = self.calculate_NCE_loss(self.real_B_mod_A, self.idt_B)
+            self.loss_NCE_Y_pix = loss_NCE_pix[1]
             loss_NCE_both_pix = (loss_NCE_both_pix + self.loss_NCE_Y_pix) * 0.5
         if self.opt.model.nce_idt and self.opt.model.lambda_NCE_feat > 0.0:
             src_vol = prepare_data_for_seg(self.data_B, self.lidar_B)
@@ -181,33 +187,33 @@ class CUTModel(BaseModel):
 
         loss_NCE_both = (loss_NCE_both_pix + loss_NCE_both_feat)
         self.loss_G = self.loss_G_GAN + loss_NCE_both
-        self.loss_G.backward()
+        self.backward(self.loss_G, 'G')
 
 
     def optimize_parameters(self):
         # forward
-        self.forward()
+        with self.autocast():
+            self.forward()
         # update D
         self.set_requires_grad(self.netD, True)
         self.optimizer_D.zero_grad()
-        self.backward_D()
-        self.optimizer_D.step()
+        with self.autocast():
+            self.backward_D()
+        self.step('D', self.optimizer_D)
         # update G
         self.set_requires_grad(self.netD, False)
-        self.optimizer_G.zero_grad()
+        optimizers = [self.optimizer_G]
         if self.opt.model.lambda_NCE > 0.0 and self.opt.model.netF == 'mlp_sample':
-            self.optimizer_F.zero_grad()
+            optimizers.append(self.optimizer_F)
         if self.opt.model.lambda_NCE_feat > 0.0:
-            self.optimizer_F_feat.zero_grad()
-        self.backward_G()
-        self.optimizer_G.step()
-        if self.opt.model.lambda_NCE > 0.0 and self.opt.model.netF == 'mlp_sample':
-            self.optimizer_F.step()
-        if self.opt.model.lambda_NCE_feat > 0.0:
-            self.optimizer_F_feat.step()
+            optimizers.append(self.optimizer_F_feat)
+        for optimizer in optimizers:
+            optimizer.zero_grad()
+        with self.autocast():
+            self.backward_G()
+        self.step('G', *optimizers)
 
-    def calculate_NCE_loss(self, src, tgt):
-        n_layers = len(self.nce_layers)
+    def match_NCE_channels(self, src, tgt):
         if len(self.opt.model.modality_A) > len(self.opt.model.modality_B):
             diff_ch = 0
             for m in set(self.opt.model.modality_A).difference(self.opt.model.modality_B):
@@ -218,27 +224,53 @@ class CUTModel(BaseModel):
             src[:, 0:diff_ch] = extra_ch  
             # extra_ch = src[:, 0:diff_ch].clone()
             tgt = torch.cat([extra_ch, tgt], dim=1)
+        return src, tgt
 
-        feat_q = self.netG(tgt, self.nce_layers, encode_only=True)
+    def encode_NCE(self, inputs):
+        """nce_layers features of every input, inputs of the same shape go through netG in one batch."""
+        if not self.nce_encode_together:
+            return [self.netG(x, self.nce_layers, encode_only=True) for x in inputs]
+        groups = {}
+        for i, x in enumerate(inputs):
+            groups.setdefault(x.shape[1:], []).append(i)
+        feats = [None] * len(inputs)
+        for ids in groups.values():
+            batch = [inputs[i] for i in ids]
+            batch_feats = self.netG(torch.cat(batch), self.nce_layers, encode_only=True)
+            splits = [f.split([x.size(0) for x in batch]) for f in batch_feats]
+            for j, i in enumerate(ids):
+                feats[i] = [f[j] for f in splits]
+        return feats
 
-        if self.opt.model.flip_equivariance and self.flipped_for_equivariance:
-            feat_q = [torch.flip(fq, [3]) for fq in feat_q]
+    def calculate_NCE_loss(self, src, tgt):
+        return self.calculate_NCE_losses([(src, tgt)])[0]
 
-        feat_k = self.netG(src, self.nce_layers, encode_only=True)
-        feat_k_pool, sample_ids = self.netF(feat_k, self.opt.model.num_patches, None)
-        feat_q_pool, _ = self.netF(feat_q, self.opt.model.num_patches, sample_ids)
+    def calculate_NCE_losses(self, pairs):
+        """PatchNCE loss of every (src, tgt) pair, with the features of all pairs from one encoder pass."""
+        n_layers = len(self.nce_layers)
+        pairs = [self.match_NCE_channels(src, tgt) for src, tgt in pairs]
+        feats = self.encode_NCE([x for pair in pairs for x in pair])
+        losses = []
+        for feat_k, feat_q in zip(feats[0::2], feats[1::2]):
+            if self.opt.model.flip_equivariance and self.flipped_for_equivariance:
+                feat_q = [torch.flip(fq, [3]) for fq in feat_q]
 
-        total_nce_loss = 0.0
-        for f_q, f_k, crit, nce_layer in zip(feat_q_pool, feat_k_pool, self.criterionNCE, self.nce_layers):
-            loss = crit(f_q, f_k) * self.opt.model.lambda_NCE
-            total_nce_loss += loss.mean()
+            feat_k_pool, sample_ids = self.netF(feat_k, self.opt.model.num_patches, None)
+            feat_q_pool, _ = self.netF(feat_q, self.opt.model.num_patches, sample_ids)
 
-        return total_nce_loss / n_layers
+            # the criteria of all layers are identical, the layers are computed in one fused call
+            total_nce_loss = 0.0
+            for loss in self.criterionNCE[0].forward_layers(feat_q_pool, feat_k_pool):
+                total_nce_loss += (loss * self.opt.model.lambda_NCE).mean()
+            losses.append(total_nce_loss / n_layers)
+        return losses
 
 
     def calculate_NCE_feat_loss(self, src_vol, tgt_vol):
         _, feat_q = self.seg_model(tgt_vol)
-        _, feat_k = self.seg_model(src_vol)
+        # the keys are detached by PatchNCE, the real features need no graph
+        with torch.no_grad():
+            _, feat_k = self.seg_model(src_vol)
         feat_q = [feat_q]
         feat_k = [feat_k]
         feat_k_pool, sample_ids = self.netF_feat(feat_k, self.opt.model.num_patches, None)
@@ -94,7 +94,7 @@ class CycleGANModel(BaseModel):
         # Combined loss
         loss_D = (loss_D_real + loss_D_fake) * 0.5
         # backward
-        loss_D.backward()
+        self.backward(loss_D, 'D')
         return loss_D
 
 
@@ -139,21 +139,24 @@ class CycleGANModel(BaseModel):
 
         self.loss_G = self.loss_G_A + self.loss_G_B + self.loss_cycle_A + self.loss_cycle_B + self.loss_idt_A + self.loss_idt_B
 
-        self.loss_G.backward()
+        self.backward(self.loss_G, 'G')
 
 
     def optimize_parameters(self):
         # forward
-        self.forward()
+        with self.autocast():
+            self.forward()
         self.set_requires_grad([self.netD_A, self.netD_B], False)
         self.optimizer_G.zero_grad() 
-        self.backward_G()
-        self.optimizer_G.step() 
+        with self.autocast():
+            self.backward_G()
+        self.step('G', self.optimizer_G)
         self.set_requires_grad([self.netD_A, self.netD_B], True)
         self.optimizer_D.zero_grad()   # set D_A and D_B's gradients to zero
-        self.backward_D_A()      # calculate gradients for D_A
-        self.backward_D_B()      # calculate graidents for D_B
-        self.optimizer_D.step()  # update D_A and D_B's weights
+        with self.autocast():
+            self.backward_D_A()      # calculate gradients for D_A
+            self.backward_D_B()      # calculate graidents for D_B
+        self.step('D', self.optimizer_D)  # update D_A and D_B's weights
 
 
  
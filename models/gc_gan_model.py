@@ -111,7 +111,7 @@ class GcGANModel(BaseModel):
         loss_D += (loss_D_gc_real + loss_D_gc_fake) * 0.5
 
         # backward
-        loss_D.backward()
+        self.backward(loss_D, 'D')
         return loss_D
 
 
@@ -217,7 +217,7 @@ class GcGANModel(BaseModel):
 
         loss_G = loss_G_AB + loss_G_gc_AB + loss_gc + loss_idt + loss_idt_gc
 
-        loss_G.backward()
+        self.backward(loss_G, 'G')
 
         self.fake_B = fake_B.data
         self.fake_gc_B = fake_gc_B.data
@@ -229,15 +229,18 @@ class GcGANModel(BaseModel):
 
     def optimize_parameters(self):
         # forward
-        self.forward()
+        with self.autocast():
+            self.forward()
         # G_AB
         self.optimizer_G.zero_grad()
-        self.backward_G()
-        self.optimizer_G.step()
+        with self.autocast():
+            self.backward_G()
+        self.step('G', self.optimizer_G)
         # D_B and D_gc_B
         self.optimizer_D_B.zero_grad()
-        self.backward_D_B()
-        self.optimizer_D_B.step()
+        with self.autocast():
+            self.backward_D_B()
+        self.step('D', self.optimizer_D_B)
 
 
  
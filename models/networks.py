@@ -4,6 +4,7 @@ from torch.nn import init
 import functools
 from torch.optim import lr_scheduler
 from util import m2ch
+from util.amp import full_precision
 import numpy as np
 import torch.nn.functional as F
 from .stylegan_networks import StyleGAN2Discriminator, StyleGAN2Generator, TileStyleGAN2Discriminator
@@ -119,6 +120,7 @@ class GumbelSigmoid(nn.Module):
         else:
             return torch.sigmoid(logits / self.tau)
 
+    @full_precision
     def forward(self, logits, threshold: float = 0.5):
         if self.fixed_noise is None:
             logits = logits + self.logistic_noise(logits)
@@ -581,6 +583,8 @@ class PatchSampleF(nn.Module):
         self.init_type = init_type
         self.init_gain = init_gain
         self.gpu_ids = gpu_ids
+        # patch ids are drawn on the device of the features, seeded from the global torch seed
+        self.generator = None
 
     def create_mlp(self, feats):
         for mlp_id, feat in enumerate(feats):
@@ -592,37 +596,64 @@ class PatchSampleF(nn.Module):
         init_net(self, self.init_type, self.init_gain, self.gpu_ids)
         self.mlp_init = True
 
+    def sample_ids(self, n_layers, n_pixels, num_patches, device):
+        # a uniform subset of pixels per layer: the largest num_patches of n_pixels uniform draws.
+        # drawn on the device, torch.randperm on CUDA is avoided (https://github.com/taesungp/contrastive-unpaired-translation/issues/83)
+        if self.generator is None or self.generator.device != device:
+            self.generator = torch.Generator(device=device)
+            self.generator.manual_seed(int(torch.randint(2 ** 62, (1,))))
+        noise = torch.rand(n_layers, n_pixels, generator=self.generator, device=device)
+        return noise.topk(min(num_patches, n_pixels), dim=1).indices
+
+    def project(self, x, feat_ids):
+        # the MLPs of layers of the same width as two batched matmuls, x: (L, N, C)
+        mlps = [getattr(self, 'mlp_%d' % feat_id) for feat_id in feat_ids]
+        if len(mlps) == 1:
+            return mlps[0](x[0])[None]
+        w1, b1 = torch.stack([m[0].weight for m in mlps]), torch.stack([m[0].bias for m in mlps])
+        w2, b2 = torch.stack([m[2].weight for m in mlps]), torch.stack([m[2].bias for m in mlps])
+        x = torch.relu(torch.baddbmm(b1[:, None], x, w1.transpose(1, 2)))
+        return torch.baddbmm(b2[:, None], x, w2.transpose(1, 2))
+
     def forward(self, feats, num_patches=64, patch_ids=None):
-        return_ids = []
-        return_feats = []
         if self.use_mlp and not self.mlp_init:
             self.create_mlp(feats)
+        if num_patches == 0:
+            return self.forward_dense(feats)
+        return_ids = [None] * len(feats)
+        return_feats = [None] * len(feats)
+        # layers of the same shape draw their patch ids and run their MLPs together
+        groups = {}
         for feat_id, feat in enumerate(feats):
-            B, H, W = feat.shape[0], feat.shape[2], feat.shape[3]
-            feat_reshape = feat.permute(0, 2, 3, 1).flatten(1, 2)
-            if num_patches > 0:
-                if patch_ids is not None:
-                    patch_id = patch_ids[feat_id]
-                else:
-                    # torch.randperm produces cudaErrorIllegalAddress for newer versions of PyTorch. https://github.com/taesungp/contrastive-unpaired-translation/issues/83
-                    #patch_id = torch.randperm(feat_reshape.shape[1], device=feats[0].device)
-                    patch_id = np.random.permutation(feat_reshape.shape[1])
-                    patch_id = patch_id[:int(min(num_patches, patch_id.shape[0]))]  # .to(patch_ids.device)
-                patch_id = torch.tensor(patch_id, dtype=torch.long, device=feat.device)
-                x_sample = feat_reshape[:, patch_id, :].flatten(0, 1)  # reshape(-1, x.shape[1])
+            groups.setdefault(tuple(feat.shape), []).append(feat_id)
+        for (B, C, H, W), feat_ids in groups.items():
+            device = feats[feat_ids[0]].device
+            if patch_ids is not None:
+                patch_id = torch.stack([torch.as_tensor(patch_ids[i], dtype=torch.long, device=device) for i in feat_ids])
             else:
-                x_sample = feat_reshape
-                patch_id = []
+                patch_id = self.sample_ids(len(feat_ids), H * W, num_patches, device)
+            # gather the sampled pixels from the (B, C, H*W) maps, without permuting the whole map
+            x_sample = torch.stack([feats[i].flatten(2).gather(2, p.expand(B, C, -1)) for i, p in zip(feat_ids, patch_id[:, None, None])])
+            x_sample = x_sample.transpose(2, 3).flatten(1, 2)  # (L, B * P, C)
+            if self.use_mlp:
+                x_sample = self.project(x_sample, feat_ids)
+            for feat_id, p, x in zip(feat_ids, patch_id, x_sample):
+                return_ids[feat_id] = p
+                return_feats[feat_id] = self.l2norm(x)
+        return return_feats, return_ids
+
+    def forward_dense(self, feats):
+        # every pixel of every layer, returned as (B, C, H, W) maps
+        return_feats = []
+        for feat_id, feat in enumerate(feats):
+            B, H, W = feat.shape[0], feat.shape[2], feat.shape[3]
+            x_sample = feat.permute(0, 2, 3, 1).flatten(1, 2)
             if self.use_mlp:
                 mlp = getattr(self, 'mlp_%d' % feat_id)
                 x_sample = mlp(x_sample)
-            return_ids.append(patch_id)
             x_sample = self.l2norm(x_sample)
-
-            if num_patches == 0:
-                x_sample = x_sample.permute(0, 2, 1).reshape([B, x_sample.shape[-1], H, W])
-            return_feats.append(x_sample)
-        return return_feats, return_ids
+            return_feats.append(x_sample.permute(0, 2, 1).reshape([B, x_sample.shape[-1], H, W]))
+        return return_feats, [[] for _ in feats]
 
 class G_Resnet(nn.Module):
     def __init__(self, input_nc, output_nc, nz, num_downs, n_res, ngf=64,
@@ -816,6 +847,7 @@ class GANLoss(nn.Module):
             target_tensor = self.fake_label
         return target_tensor.expand_as(prediction)
 
+    @full_precision
     def __call__(self, prediction, target_is_real):
         """Calculate loss given Discriminator's output and grount truth labels.
 
@@ -964,12 +996,16 @@ class ResnetGenerator(nn.Module):
 
         if -1 in layers:
             layers.append(len(self.model))
+        # encoding stops at the deepest requested layer, the rest of the network is not run
+        last_layer = max(layers) if encode_only and len(layers) > 0 else len(self.model)
         feat = input
         feats = []
         for layer_id, layer in enumerate(self.model):
             feat = layer(feat)
             if layer_id in layers:
                 feats.append(feat)
+            if layer_id == last_layer:
+                break
             if cond is not None and layer_id == cond_layer - 1:
                 feat += cond
                 # print('encoder only return features')
@@ -1143,12 +1179,16 @@ class UnetGenerator(nn.Module):
         feed_layers = []
         if -1 in layers:
             layers.append(len(self.model))
+        # encoding stops at the deepest requested layer, the rest of the network is not run
+        last_layer = max(layers) if encode_only and len(layers) > 0 else len(self.model)
         feat = input
         feats = []
         for layer_id, layer in enumerate(self.model):
             feat = layer(feat)
             if layer_id in layers:
                 feats.append(feat)
+            if layer_id == last_layer:
+                break
             if layer_id < self.num_downs - 1:
                 feed_layers.append(feat)
             if cond is not None and layer_id == cond_layer - 1:
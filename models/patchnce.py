@@ -2,6 +2,18 @@ from packaging import version
 import torch
 from torch import nn
 
+from util.amp import full_precision
+
+# diagonal masks of the negative logits, {(npatches, device, dtype): (1, npatches, npatches) mask}
+_diagonal_masks = {}
+
+
+def diagonal_mask(npatches, device, dtype):
+    key = (npatches, device, dtype)
+    if key not in _diagonal_masks:
+        _diagonal_masks[key] = torch.eye(npatches, device=device, dtype=dtype)[None, :, :]
+    return _diagonal_masks[key]
+
 
 class PatchNCELoss(nn.Module):
     def __init__(self, opt, batch_size):
@@ -11,6 +23,7 @@ class PatchNCELoss(nn.Module):
         self.mask_dtype = torch.uint8 if version.parse(torch.__version__) < version.parse('1.2.0') else torch.bool
         self.batch_size = batch_size
 
+    @full_precision
     def forward(self, feat_q, feat_k):
         num_patches = feat_q.shape[0]
         dim = feat_q.shape[1]
@@ -44,7 +57,7 @@ class PatchNCELoss(nn.Module):
 
         # diagonal entries are similarity between same features, and hence meaningless.
         # just fill the diagonal with very small number, which is exp(-10) and almost zero
-        diagonal = torch.eye(npatches, device=feat_q.device, dtype=self.mask_dtype)[None, :, :]
+        diagonal = diagonal_mask(npatches, feat_q.device, self.mask_dtype)
         l_neg_curbatch.masked_fill_(diagonal, -10.0)
         l_neg = l_neg_curbatch.view(-1, npatches)
 
@@ -53,4 +66,48 @@ class PatchNCELoss(nn.Module):
         loss = self.cross_entropy_loss(out, torch.zeros(out.size(0), dtype=torch.long,
                                                         device=feat_q.device))
 
-        return loss
\ No newline at end of file
+        return loss
+
+    @full_precision
+    def forward_layers(self, feat_qs, feat_ks):
+        """Per-patch losses of every layer, as `forward` on each (feat_q, feat_k) pair, in one batched pass.
+
+        Layers are zero padded to a common feature width (dot products are
+        unchanged) and patch count; padded negatives get -inf logits and
+        padded patches are dropped from the returned losses.
+        """
+        # full_precision only casts tensor arguments, not lists of them
+        feat_qs = [f.float() for f in feat_qs]
+        feat_ks = [f.float() for f in feat_ks]
+        batch_dim_for_bmm = 1 if self.opt.nce_includes_all_negatives_from_minibatch else self.batch_size
+        n_layers = len(feat_qs)
+        npatches = [f.shape[0] // batch_dim_for_bmm for f in feat_qs]
+        P, D = max(npatches), max(f.shape[1] for f in feat_qs)
+        device = feat_qs[0].device
+        padded = any(n != P for n in npatches) or any(f.shape[1] != D for f in feat_qs)
+        if padded:
+            q = feat_qs[0].new_zeros(n_layers, batch_dim_for_bmm, P, D)
+            k = torch.zeros_like(q)
+            for i, (feat_q, feat_k) in enumerate(zip(feat_qs, feat_ks)):
+                q[i, :, :npatches[i], :feat_q.shape[1]] = feat_q.view(batch_dim_for_bmm, -1, feat_q.shape[1])
+                k[i, :, :npatches[i], :feat_k.shape[1]] = feat_k.detach().view(batch_dim_for_bmm, -1, feat_k.shape[1])
+        else:
+            q = torch.stack(feat_qs)
+            k = torch.stack([feat_k.detach() for feat_k in feat_ks])
+        q = q.view(n_layers * batch_dim_for_bmm, P, D)
+        k = k.view(n_layers * batch_dim_for_bmm, P, D)
+
+        # the temperature is applied to q (N x D) instead of the logits (N x N),
+        # the positive logits are the diagonal of the query-key products
+        q = q / self.opt.nce_T
+        l_neg = torch.bmm(q, k.transpose(2, 1))
+        l_pos = l_neg.diagonal(dim1=1, dim2=2).clone()
+        l_neg.masked_fill_(diagonal_mask(P, device, self.mask_dtype), -10.0 / self.opt.nce_T)
+        if padded:
+            valid = torch.arange(P, device=device) < torch.tensor(npatches, device=device)[:, None]  # (L, P)
+            l_neg.masked_fill_(~valid.repeat_interleave(batch_dim_for_bmm, dim=0)[:, None, :], float('-inf'))
+
+        out = torch.cat((l_pos[..., None], l_neg), dim=2).view(-1, P + 1)
+        loss = self.cross_entropy_loss(out, torch.zeros(out.size(0), dtype=torch.long, device=device))
+        loss = loss.view(n_layers, batch_dim_for_bmm, P)
+        return [loss[i, :, :n].flatten() for i, n in enumerate(npatches)]
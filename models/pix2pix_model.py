@@ -123,16 +123,19 @@ class Pix2PixModel(BaseModel):
         
 
     def optimize_parameters(self):
-        self.forward()                   # compute fake images: G(A)
+        with self.autocast():
+            self.forward()                   # compute fake images: G(A)
         # update D
         self.set_requires_grad(self.netD, True)  # enable backprop for D
         self.optimizer_D.zero_grad()     # set D's gradients to zero
-        self.calc_loss_D()
-        self.loss_D.backward()                # calculate gradients for D
-        self.optimizer_D.step()          # update D's weights
+        with self.autocast():
+            self.calc_loss_D()
+        self.backward(self.loss_D, 'D')                # calculate gradients for D
+        self.step('D', self.optimizer_D)          # update D's weights
         # update G
         self.set_requires_grad(self.netD, False)  # D requires no gradients when optimizing G
         self.optimizer_G.zero_grad()        # set G's gradients to zero
-        self.calc_loss_G()
-        self.loss_G.backward()                   # calculate graidents for G
-        self.optimizer_G.step()             # udpate G's weights
+        with self.autocast():
+            self.calc_loss_G()
+        self.backward(self.loss_G, 'G')                   # calculate graidents for G
+        self.step('G', self.optimizer_G)             # udpate G's weights
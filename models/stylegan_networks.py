@@ -11,6 +11,7 @@ import random
 import torch
 from torch import nn
 from util import m2ch
+from util.amp import full_precision
 from torch.nn import functional as F
 
 
@@ -57,6 +58,7 @@ class GumbelSigmoid(nn.Module):
         else:
             return torch.sigmoid(logits / self.tau)
 
+    @full_precision
     def forward(self, logits, threshold: float = 0.5):
         if self.fixed_noise is None:
             logits = logits + self.logistic_noise(logits)
@@ -2,10 +2,8 @@ import argparse
 import multiprocessing
 import os
 import os.path as osp
-from collections import defaultdict
 from glob import glob
 
-import joblib
 import matplotlib.cm as cm
 import numpy as np
 import torch
@@ -17,50 +15,12 @@ from nuscenes.nuscenes import NuScenes
 import pathlib
 from dataset.kitti_odometry import KITTIOdometry
 from dataset.nuscene import NuScene
+from dataset.shard import convert_projected_to_shards
+from dataset.camera import CameraProjection, open_image, image_to_pcl
+from dataset.preprocess_runner import atomic_write, run_tasks
+from dataset.statistics import compute_statistics, save_statistics
 from collections import namedtuple
-from util import make_class_from_dict
-
-def car2hom(pc):
-    return np.concatenate([pc[:, :3], np.ones((pc.shape[0], 1), dtype=pc.dtype)], axis=-1)
-
-def image_to_pcl(rgb_image, point_cloud, velo_to_camera_rect, cam_intrinsic):
-        rgb = np.zeros((len(point_cloud),3), dtype=np.int32)
-        height, width, _ = rgb_image.shape
-        hom_pcl_points = car2hom(point_cloud[:, :3]).T
-        pcl_in_cam_rect = np.dot(velo_to_camera_rect, hom_pcl_points)
-        pcl_in_image = np.dot(cam_intrinsic, pcl_in_cam_rect)
-        pcl_in_image = np.array([pcl_in_image[0] / pcl_in_image[2], pcl_in_image[1] / pcl_in_image[2], pcl_in_image[2]])
-        canvas_mask = (pcl_in_image[0] > 0.0) & (pcl_in_image[0] < width) & (pcl_in_image[1] > 0.0)\
-            & (pcl_in_image[1] < height) & (pcl_in_image[2] > 0.0)
-        valid_pcl_in_image = pcl_in_image[:, canvas_mask].astype('int32')
-        rgb[canvas_mask] = rgb_image[valid_pcl_in_image[1], valid_pcl_in_image[0], :]
-        return rgb
-
-def _map(label, mapdict):
-    # put label from original values to xentropy
-    # or vice-versa, depending on dictionary values
-    # make learning map a lookup table
-    maxkey = 0
-    for key, data in mapdict.items():
-        if isinstance(data, list):
-            nel = len(data)
-        else:
-            nel = 1
-        if key > maxkey:
-            maxkey = key
-    # +100 hack making lut bigger just in case there are unknown labels
-    if nel > 1:
-        lut = np.zeros((maxkey + 100, nel), dtype=np.int32)
-    else:
-        lut = np.zeros((maxkey + 100), dtype=np.int32)
-    for key, data in mapdict.items():
-        try:
-            lut[key] = data
-        except IndexError:
-            print("Wrong key ", key)
-    # do the mapping
-    return lut[label]
-
+from util import make_class_from_dict, _map
 
 # support semantic kitti only for this script
 
@@ -134,18 +94,46 @@ def load_calib(root):
         return calib
 
 
-def process_point_clouds(point_path, H, W, dest_dir, calib=None, name=None):
-    is_sorted = name == 'kitti'
+def source_paths(point_path):
+    label_path = point_path.replace("/velodyne", "/labels").replace(".bin", ".label")
+    image_path = point_path.replace("/velodyne", "/image_2").replace(".bin", ".png")
+    tag_path = point_path.replace("/velodyne", "/tag").replace(".bin", ".tag")
+    return label_path, image_path, tag_path
+
+
+def projected_paths(point_path, dest_dir):
+    """Output files of process_point_clouds: the projected scan, then the label and rgb images if their sources exist."""
     def save_dir(x):
         prev_split = x.split(os.path.sep)
         seq_mode_filename = os.path.sep.join(prev_split[-4:])
         return os.path.join(dest_dir, "projected", seq_mode_filename)
+    label_path, image_path, _ = source_paths(point_path)
+    paths = [save_dir(point_path).replace(".bin", ".npy")]
+    if osp.exists(label_path):
+        paths.append(save_dir(label_path).replace(".label", ".png"))
+    if osp.exists(image_path):
+        paths.append(save_dir(image_path))
+    return paths
+
+
+def nucs_projected_paths(point_path, label_path):
+    """Output files of process_nucs_point_clouds: the projected scan, then the label image if the label exists."""
+    filename = point_path.split(os.path.sep)[-1]
+    root_dir = os.path.sep.join(point_path.split(os.path.sep)[:-1])
+    root_dir = root_dir.replace('nuscene_lidarseg', 'projected_nuscene_lidarseg')
+    paths = [osp.join(root_dir, 'PCL', filename).replace(".bin", ".npy")]
+    if osp.exists(label_path):
+        paths.append(osp.join(root_dir, 'label', filename).replace(".bin", ".png"))
+    return paths
+
+
+def process_point_clouds(point_path, H, W, dest_dir, calib=None, name=None):
+    is_sorted = name == 'kitti'
+    save_paths = iter(projected_paths(point_path, dest_dir))
     # setup point clouds
     points = np.fromfile(point_path, dtype=np.float32).reshape((-1, 4))
     # for semantic kitti
-    label_path = point_path.replace("/velodyne", "/labels").replace(".bin", ".label")
-    image_path = point_path.replace("/velodyne", "/image_2").replace(".bin", ".png")
-    tag_path = point_path.replace("/velodyne", "/tag").replace(".bin", ".tag")
+    label_path, image_path, tag_path = source_paths(point_path)
     if osp.exists(label_path):
         label = np.fromfile(label_path, dtype=np.int32)
         sem_label = label & 0xFFFF 
@@ -153,10 +141,8 @@ def process_point_clouds(point_path, H, W, dest_dir, calib=None, name=None):
             sem_label = _map(sem_label, labelmap)
         points = np.concatenate([points, sem_label.astype('float32')[:, None]], axis=1)
     if osp.exists(image_path):
-        velo_to_camera_rect =calib.T_cam2_velo
-        cam_intrinsic = calib.P_rect_20
-        rgb_image = np.array(Image.open(image_path))
-        rgb = image_to_pcl(rgb_image, points, velo_to_camera_rect, cam_intrinsic)
+        camera = CameraProjection(calib.T_cam2_velo, calib.P_rect_20)
+        rgb = image_to_pcl(camera, open_image(image_path), points)
         points = np.concatenate([points, rgb.astype('float32')], axis=1)
 
     
@@ -164,28 +150,18 @@ def process_point_clouds(point_path, H, W, dest_dir, calib=None, name=None):
     proj, _ = point_cloud_to_xyz_image(points, H, W, is_sorted=is_sorted, tag=tag)
 
 
-    save_path = save_dir(point_path).replace(".bin", ".npy")
-    os.makedirs(osp.dirname(save_path), exist_ok=True)
-    np.save(save_path, proj[..., :4])
+    atomic_write(next(save_paths), lambda f: np.save(f, proj[..., :4]))
     if osp.exists(label_path):
-        save_path = save_dir(label_path).replace(".label", ".png")
-        os.makedirs(osp.dirname(save_path), exist_ok=True)
         labels = Image.fromarray(np.uint8(proj[..., 4]), mode="P")
         labels.putpalette(palette)
-        labels.save(save_path)
+        atomic_write(next(save_paths), lambda f: labels.save(f, format='PNG'))
     if osp.exists(image_path):
-        save_path = save_dir(image_path)
-        os.makedirs(osp.dirname(save_path), exist_ok=True)
         rgb = Image.fromarray(proj[..., 5:8].astype('uint8'))
-        rgb.save(save_path)
+        atomic_write(next(save_paths), lambda f: rgb.save(f, format='PNG'))
 
 
 def process_nucs_point_clouds(point_path, label_path, H, W):
-    filename = point_path.split(os.path.sep)[-1]
-    root_dir = os.path.sep.join(point_path.split(os.path.sep)[:-1])
-    root_dir = root_dir.replace('nuscene_lidarseg', 'projected_nuscene_lidarseg')
-    save_dir = osp.join(root_dir, 'PCL', filename)
-    label_save_dir = osp.join(root_dir, 'label', filename)
+    save_paths = iter(nucs_projected_paths(point_path, label_path))
     # setup point clouds
     points = np.fromfile(point_path, dtype=np.float32).reshape((-1, 5))[:, [1, 0, 2, 3]]; points[:, 0] = -points[:, 0]
     # for semantic kitti
@@ -195,65 +171,10 @@ def process_nucs_point_clouds(point_path, label_path, H, W):
     proj, _ = point_cloud_to_xyz_image(points, H, W, fov_up=10.0, fov_down=-30.0, is_sorted=False)
 
 
-    save_path = save_dir.replace(".bin", ".npy")
-    os.makedirs(osp.dirname(save_path), exist_ok=True)
-    np.save(save_path, proj[..., :4])
+    atomic_write(next(save_paths), lambda f: np.save(f, proj[..., :4]))
     if osp.exists(label_path):
-        save_path = label_save_dir.replace(".bin", ".png")
-        os.makedirs(osp.dirname(save_path), exist_ok=True)
         labels = Image.fromarray(np.uint8(proj[..., 4]))
-        labels.save(save_path)
-
-def mean(tensor, dim):
-    tensor = tensor.clone()
-    kwargs = {"dim": dim, "keepdim": True}
-    valid = (~tensor.isnan()).float()
-    tensor[tensor.isnan()] = 0
-    tensor = torch.sum(tensor * valid, **kwargs) / valid.sum(**kwargs)
-    return tensor
-
-
-@torch.no_grad()
-def compute_avg_angles(loader):
-
-    max_depth = loader.dataset.max_depth
-    summary = defaultdict(float)
-
-    for item in tqdm(loader):
-        xyz_batch = item["points"]
-
-        x = xyz_batch[:, [0]]
-        y = xyz_batch[:, [1]]
-        z = xyz_batch[:, [2]]
-
-        depth = torch.sqrt(x ** 2 + y ** 2 + z ** 2) * max_depth
-        valid = (depth > 1e-8).float()
-        summary["total_data"] += len(valid)
-        summary["total_valid"] += valid.sum(dim=0)  # (1,64,2048)
-
-        r = torch.sqrt(x ** 2 + y ** 2)
-        pitch = torch.atan2(z, r)
-        yaw = torch.atan2(y, x)
-        summary["pitch"] += torch.sum(pitch * valid, dim=0)
-        summary["yaw"] += torch.sum(yaw * valid, dim=0)
-
-    summary["pitch"] = summary["pitch"] / summary["total_valid"] 
-    summary["yaw"] = summary["yaw"] / summary["total_valid"] 
-    angles = torch.cat([summary["pitch"], summary["yaw"]], dim=0)
-
-    mean_pitch = mean(summary["pitch"], 2).expand_as(summary["pitch"])
-    mean_yaw = mean(summary["yaw"], 1).expand_as(summary["yaw"])
-    mean_angles = torch.cat([mean_pitch, mean_yaw], dim=0)
-
-    mean_valid = summary["total_valid"] / summary["total_data"]
-    valid = (mean_valid > 0).float()
-    angles[angles.isnan()] = 0.0
-    angles = valid * angles + (1 - valid) * mean_angles
-
-    assert angles.isnan().sum() == 0
-
-    return angles, mean_valid
-
+        atomic_write(next(save_paths), lambda f: labels.save(f, format='PNG'))
 
 if __name__ == "__main__":
 
@@ -262,27 +183,31 @@ if __name__ == "__main__":
     parser.add_argument("--dest-dir", type=str, required=True)
     parser.add_argument("--dataset-name", type=str, required=True)
     parser.add_argument("--project", action='store_true')
+    parser.add_argument("--pack-shards", action='store_true', help='pack <root-dir>/sequences (projected layout) into memmap shards')
+    parser.add_argument("--num-workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--files-per-task", type=int, default=16, help='files processed by a worker per task')
+    parser.add_argument("--with-labels", action='store_true', help='also accumulate the class histogram')
     args = parser.parse_args()
     DATA =  make_class_from_dict(yaml.safe_load(open(f'configs/dataset_cfg/{args.dataset_name}_cfg.yml', 'r')))
     H, W = DATA.height, DATA.width
-    if args.project:
+    if args.pack_shards:
+        convert_projected_to_shards(args.root_dir)
+    elif args.project:
         if args.dataset_name in ['kitti', 'carla', 'semanticPOSS']:
             # calib = load_calib(osp.join(args.root_dir, "dataset/sequences"))
             calib = None
             # H, W = 64, 2048
             split_dirs = sorted(glob(osp.join(args.root_dir, "dataset/sequences", "*")))
-            for split_dir in tqdm(split_dirs):
-                point_paths = sorted(glob(osp.join(split_dir, "velodyne", "*.bin")))
-                joblib.Parallel(
-                    n_jobs=multiprocessing.cpu_count(), verbose=10, pre_dispatch="all"
-                )(
-                    [
-                        joblib.delayed(process_point_clouds)(point_path, H, W, args.dest_dir, calib, args.dataset_name)
-                        for point_path in point_paths
-                    ]
-                )
-            
-         
+            point_paths = [p for split_dir in split_dirs for p in sorted(glob(osp.join(split_dir, "velodyne", "*.bin")))]
+            # finished scans are recorded in the ledger of this projection config, rerunning resumes an interrupted run
+            config = {'H': H, 'W': W, 'fov_up': 3.0, 'fov_down': -25.0, 'name': args.dataset_name,
+                      'calib': None if calib is None else {k: np.asarray(v).tolist() for k, v in calib._asdict().items()}}
+            run_tasks(process_point_clouds,
+                      [(p, (p, H, W, args.dest_dir, calib, args.dataset_name)) for p in point_paths],
+                      osp.join(args.dest_dir, f'{args.dataset_name}_project_ledger.txt'),
+                      num_workers=args.num_workers, batch_size=args.files_per_task, desc='project',
+                      config=config, outputs=lambda p: projected_paths(p, args.dest_dir))
+
 
         elif args.dataset_name == 'nuscene':
             nusc = NuScenes(version = 'v1.0-mini', dataroot = args.root_dir, verbose = True)
@@ -295,14 +220,13 @@ if __name__ == "__main__":
                 label_path = (pathlib.Path(nusc.dataroot) / nusc.get("lidarseg", sample_data_token)["filename"])
                 datalist.append(sample_path)
                 labels_list.append(label_path)
-            joblib.Parallel(
-                n_jobs=multiprocessing.cpu_count(), verbose=10, pre_dispatch="all"
-            )(
-                [
-                    joblib.delayed(process_nucs_point_clouds)(point_path, label_path, H, W)
-                    for point_path, label_path in zip(datalist, labels_list)
-                ]
-            ) 
+            label_of = {str(p): str(l) for p, l in zip(datalist, labels_list)}
+            run_tasks(process_nucs_point_clouds,
+                      [(str(p), (p, str(l), H, W)) for p, l in zip(datalist, labels_list)],
+                      osp.join(args.dest_dir, f'{args.dataset_name}_project_ledger.txt'),
+                      num_workers=args.num_workers, batch_size=args.files_per_task, desc='project',
+                      config={'H': H, 'W': W, 'fov_up': 10.0, 'fov_down': -30.0},
+                      outputs=lambda p: nucs_projected_paths(p, label_of[p]))
     else:
         if args.dataset_name in ['kitti', 'carla', 'semanticPOSS']:
             dataset = KITTIOdometry(
@@ -311,7 +235,7 @@ if __name__ == "__main__":
             DATA,
             shape=(H, W),
             flip=False,
-            modality=['depth'],
+            modality=['depth', 'reflectance'] + (['label'] if args.with_labels else []),
             fill_in_label=False,
             name = args.dataset_name,
             limited_view=False)
@@ -319,23 +243,15 @@ if __name__ == "__main__":
             dataset = NuScene(
             args.root_dir,
             'train',
-            None,
-            shape=(32, 1024),
+            DATA,
+            shape=(H, W),
             flip=False,
-            modality=['depth'],
+            modality=['depth', 'reflectance'] + (['label'] if args.with_labels else []),
             is_sorted=False,
-            is_raw=True,
+            is_raw=DATA.is_raw,
             fill_in_label=False)
-
-        loader = torch.utils.data.DataLoader(
-            dataset,
-            batch_size=64,
-            num_workers=4,
-            drop_last=False,
-        )
-        # N = len(dataset)
-
-        angles, valid = compute_avg_angles(loader)
-        torch.save(angles, osp.join(args.root_dir, "angles.pt"))
+        # angles.pt, channel mean/std and class histogram in one pass over the frames
+        stats = compute_statistics(dataset, dataset.shape, num_workers=args.num_workers)
+        print(save_statistics(stats, args.root_dir))
     # torch.save(angles, osp.join(args.root_dir.replace('nuscene_lidarseg', 'projected_nuscene_lidarseg'), "angles.pt"))
 
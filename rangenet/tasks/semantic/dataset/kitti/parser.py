@@ -2,7 +2,8 @@ import os
 import numpy as np
 import torch
 from torch.utils.data import Dataset
-from common.laserscan import LaserScan, SemLaserScan
+from dataset.laserscan import LaserScan, SemLaserScan
+from util.label_mapper import LabelMapper
 
 EXTENSIONS_SCAN = ['.bin']
 EXTENSIONS_LABEL = ['.label']
@@ -43,6 +44,16 @@ class SemanticKitti(Dataset):
     self.sensor_fov_down = sensor["fov_down"]
     self.max_points = max_points
     self.gt = gt
+    # only holds the projection parameters, see LaserScan.project_batch; the
+    # scans are projected over the full 360 degrees
+    scan_cls = SemLaserScan if self.gt else LaserScan
+    self.scan = scan_cls(project=True,
+                         H=self.sensor_img_H,
+                         W=self.sensor_img_W,
+                         fov_up=self.sensor_fov_up,
+                         fov_down=self.sensor_fov_down,
+                         foh_left=180,
+                         foh_right=-180)
 
     # get number of classes (can't be len(self.learning_map) because there
     # are multiple repeated entries, so the number that matters is how many
@@ -106,80 +117,63 @@ class SemanticKitti(Dataset):
                                                     self.sequences))
 
   def __getitem__(self, index):
-    # get item in tensor shape
-    scan_file = self.scan_files[index]
+    return self.__getitems__([index])[0]
+
+  def __getitems__(self, indices):
+    # the DataLoader hands over the indices of a whole batch, which are
+    # projected in one go
+    scans = [np.fromfile(self.scan_files[i], dtype=np.float32).reshape((-1, 4)) for i in indices]
+    labels = [np.fromfile(self.label_files[i], dtype=np.int32) for i in indices] if self.gt else None
+    out = self.scan.project_batch([s[:, :3] for s in scans], [s[:, 3] for s in scans], labels)
     if self.gt:
-      label_file = self.label_files[index]
-
-    # open a semantic laserscan
-    if self.gt:
-      scan = SemLaserScan(self.color_map,
-                          project=True,
-                          H=self.sensor_img_H,
-                          W=self.sensor_img_W,
-                          fov_up=self.sensor_fov_up,
-                          fov_down=self.sensor_fov_down)
-    else:
-      scan = LaserScan(project=True,
-                       H=self.sensor_img_H,
-                       W=self.sensor_img_W,
-                       fov_up=self.sensor_fov_up,
-                       fov_down=self.sensor_fov_down)
-
-    # open and obtain scan
-    scan.open_scan(scan_file)
-    if self.gt:
-      scan.open_label(label_file)
       # map unused classes to used classes (also for projection)
-      scan.sem_label = self.map(scan.sem_label, self.learning_map)
-      scan.proj_sem_label = self.map(scan.proj_sem_label, self.learning_map)
-
-    # make a tensor of the uncompressed data (with the max num points)
-    unproj_n_points = scan.points.shape[0]
-    unproj_xyz = torch.full((self.max_points, 3), -1.0, dtype=torch.float)
-    unproj_xyz[:unproj_n_points] = torch.from_numpy(scan.points)
-    unproj_range = torch.full([self.max_points], -1.0, dtype=torch.float)
-    unproj_range[:unproj_n_points] = torch.from_numpy(scan.unproj_range)
-    unproj_remissions = torch.full([self.max_points], -1.0, dtype=torch.float)
-    unproj_remissions[:unproj_n_points] = torch.from_numpy(scan.remissions)
-    if self.gt:
-      unproj_labels = torch.full([self.max_points], -1.0, dtype=torch.int32)
-      unproj_labels[:unproj_n_points] = torch.from_numpy(scan.sem_label)
-    else:
-      unproj_labels = []
+      out['sem_label'] = [self.map(l, self.learning_map) for l in out['sem_label']]
+      out['proj_sem_label'] = self.map(out['proj_sem_label'], self.learning_map)
 
     # get points and labels
-    proj_range = torch.from_numpy(scan.proj_range).clone()
-    proj_xyz = torch.from_numpy(scan.proj_xyz).clone()
-    proj_remission = torch.from_numpy(scan.proj_remission).clone()
-    proj_mask = torch.from_numpy(scan.proj_mask)
-    if self.gt:
-      proj_labels = torch.from_numpy(scan.proj_sem_label).clone()
-      proj_labels = proj_labels * proj_mask
-    else:
-      proj_labels = []
-    proj_x = torch.full([self.max_points], -1, dtype=torch.long)
-    proj_x[:unproj_n_points] = torch.from_numpy(scan.proj_x)
-    proj_y = torch.full([self.max_points], -1, dtype=torch.long)
-    proj_y[:unproj_n_points] = torch.from_numpy(scan.proj_y)
-    proj = torch.cat([proj_range.unsqueeze(0).clone(),
-                      proj_xyz.clone().permute(2, 0, 1),
-                      proj_remission.unsqueeze(0).clone()])
+    proj_range = torch.from_numpy(out['proj_range'])
+    proj_xyz = torch.from_numpy(out['proj_xyz'])
+    proj_remission = torch.from_numpy(out['proj_remission'])
+    proj_mask = torch.from_numpy(out['proj_mask'])
+    proj = torch.cat([proj_range.unsqueeze(1),
+                      proj_xyz.permute(0, 3, 1, 2),
+                      proj_remission.unsqueeze(1)], dim=1)
     proj = (proj - self.sensor_img_means[:, None, None]
             ) / self.sensor_img_stds[:, None, None]
-    proj = proj * proj_mask.float()
-
-    # get name and sequence
-    path_norm = os.path.normpath(scan_file)
-    path_split = path_norm.split(os.sep)
-    path_seq = path_split[-3]
-    path_name = path_split[-1].replace(".bin", ".label")
-    # print("path_norm: ", path_norm)
-    # print("path_seq", path_seq)
-    # print("path_name", path_name)
-
-    # return
-    return proj, proj_mask, proj_labels, unproj_labels, path_seq, path_name, proj_x, proj_y, proj_range, unproj_range, proj_xyz, unproj_xyz, proj_remission, unproj_remissions, unproj_n_points
+    proj = proj * proj_mask.unsqueeze(1).float()
+    if self.gt:
+      proj_labels = torch.from_numpy(out['proj_sem_label']) * proj_mask
+
+    samples = []
+    for b, index in enumerate(indices):
+      # make a tensor of the uncompressed data (with the max num points)
+      unproj_n_points = out['points'][b].shape[0]
+      unproj_xyz = torch.full((self.max_points, 3), -1.0, dtype=torch.float)
+      unproj_xyz[:unproj_n_points] = torch.from_numpy(out['points'][b])
+      unproj_range = torch.full([self.max_points], -1.0, dtype=torch.float)
+      unproj_range[:unproj_n_points] = torch.from_numpy(out['unproj_range'][b])
+      unproj_remissions = torch.full([self.max_points], -1.0, dtype=torch.float)
+      unproj_remissions[:unproj_n_points] = torch.from_numpy(out['remissions'][b])
+      if self.gt:
+        unproj_labels = torch.full([self.max_points], -1.0, dtype=torch.int32)
+        unproj_labels[:unproj_n_points] = torch.from_numpy(out['sem_label'][b].astype(np.int32))
+      else:
+        unproj_labels = []
+      proj_x = torch.full([self.max_points], -1, dtype=torch.long)
+      proj_x[:unproj_n_points] = torch.from_numpy(out['proj_x'][b])
+      proj_y = torch.full([self.max_points], -1, dtype=torch.long)
+      proj_y[:unproj_n_points] = torch.from_numpy(out['proj_y'][b])
+
+      # get name and sequence
+      path_norm = os.path.normpath(self.scan_files[index])
+      path_split = path_norm.split(os.sep)
+      path_seq = path_split[-3]
+      path_name = path_split[-1].replace(".bin", ".label")
+
+      samples.append((proj[b], proj_mask[b], proj_labels[b] if self.gt else [], unproj_labels, path_seq, path_name,
+                      proj_x, proj_y, proj_range[b], unproj_range, proj_xyz[b], unproj_xyz, proj_remission[b],
+                      unproj_remissions, unproj_n_points))
+    return samples
 
   def __len__(self):
     return len(self.scan_files)
@@ -188,27 +182,7 @@ class SemanticKitti(Dataset):
   def map(label, mapdict):
     # put label from original values to xentropy
     # or vice-versa, depending on dictionary values
-    # make learning map a lookup table
-    maxkey = 0
-    for key, data in mapdict.items():
-      if isinstance(data, list):
-        nel = len(data)
-      else:
-        nel = 1
-      if key > maxkey:
-        maxkey = key
-    # +100 hack making lut bigger just in case there are unknown labels
-    if nel > 1:
-      lut = np.zeros((maxkey + 100, nel), dtype=np.int32)
-    else:
-      lut = np.zeros((maxkey + 100), dtype=np.int32)
-    for key, data in mapdict.items():
-      try:
-        lut[key] = data
-      except IndexError:
-        print("Wrong key ", key)
-    # do the mapping
-    return lut[label]
+    return LabelMapper.get(mapdict)(label)
 
 
 class Parser():
@@ -356,7 +330,5 @@ class Parser():
     return SemanticKitti.map(label, self.learning_map)
 
   def to_color(self, label):
-    # put label in original values
-    label = SemanticKitti.map(label, self.learning_map_inv)
-    # put label in color
-    return SemanticKitti.map(label, self.color_map)
+    # put label in original values, then in color
+    return LabelMapper.get(self.learning_map_inv, self.color_map)(label)
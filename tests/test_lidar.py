@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+import torch
+
+from util.lidar import Coordinate
+
+
+class JitteredGrid(Coordinate):
+    """Angle grid whose elevation varies along every row and azimuth along every column."""
+
+    def __init__(self, shape, jitter):
+        self.jitter = jitter
+        super().__init__(min_depth=1.0, max_depth=80.0, shape=shape)
+
+    def init_coordmap(self, H, W):
+        g = torch.Generator().manual_seed(0)
+        pitch = torch.linspace(np.radians(3.0), np.radians(-25.0), H)[:, None].expand(H, W)
+        yaw = torch.linspace(np.pi, -np.pi, W + 1)[:-1][None, :].expand(H, W)
+        pitch = pitch + self.jitter * (torch.rand(H, W, generator=g) * 2 - 1)
+        yaw = yaw + self.jitter * (torch.rand(H, W, generator=g) * 2 - 1)
+        return torch.stack([pitch, yaw])[None]
+
+
+def round_trip(coord, mode):
+    g = torch.Generator().manual_seed(1)
+    depth = torch.empty(2, 1, coord.H, coord.W).uniform_(2.0, 70.0, generator=g)
+    xyz = coord.pol_to_xyz(depth / coord.max_depth)
+    points = xyz.flatten(2).transpose(1, 2)
+    out, valid = coord.points_to_depth(points, mode=mode)
+    return coord.normalize_minmax(depth, coord.min_depth, coord.max_depth), out, valid
+
+
+@pytest.mark.parametrize("mode", ["nearest", "bilinear"])
+@pytest.mark.parametrize("jitter", [0.0, 0.002, 0.004])
+def test_points_to_depth_round_trip(mode, jitter):
+    # 0.004 rad is above half the column spacing of the 64 x 1024 grid
+    coord = JitteredGrid((64, 1024), jitter)
+    expected, out, valid = round_trip(coord, mode)
+    assert valid.all()
+    torch.testing.assert_close(out, expected, rtol=0, atol=1e-6)
+
+
+def test_points_to_depth_keeps_nearest():
+    coord = JitteredGrid((16, 64), 0.002)
+    ray = coord.rays[0, :, 5, 7]
+    points = torch.stack([ray * 0.5, ray * 0.2, torch.zeros(3)])[None]
+    out, valid = coord.points_to_depth(points)
+    assert valid.sum() == 1 and valid[0, 0, 5, 7]
+    assert torch.isclose(out[0, 0, 5, 7], coord.normalize_minmax(torch.tensor(0.2 * coord.max_depth), coord.min_depth, coord.max_depth))
@@ -0,0 +1,27 @@
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from dataset.streaming import StreamingDataset
+
+
+class Frames(Dataset):
+    def __len__(self):
+        return 203
+
+    def __getitem__(self, i):
+        return i
+
+
+def test_persistent_workers_follow_set_epoch():
+    stream = StreamingDataset(Frames(), chunk_size=16, shuffle_buffer=0)
+    stream.set_batching(10, 2, False)
+    loader = DataLoader(stream, batch_size=10, num_workers=2, persistent_workers=True)
+    reference = StreamingDataset(Frames(), chunk_size=16, shuffle_buffer=0)
+    for epoch in (5, 6, 5):  # resumed run, then a replayed epoch
+        stream.set_epoch(epoch)
+        batches = list(loader)
+        assert len(loader) == len(batches)
+        assert sorted(torch.cat(batches).tolist()) == list(range(203))
+        # the workers shard the chunk order of this epoch
+        chunks = reference.epoch_chunks(epoch)
+        assert [b[0].item() for b in batches[:2]] == [chunks[0][0], chunks[1][0]]
@@ -0,0 +1,61 @@
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from util.transfer import DevicePrefetcher, normalize_device, pack, to_device, unpack
+
+
+class ToyDataset(Dataset):
+    def __len__(self):
+        return 10
+
+    def __getitem__(self, i):
+        g = torch.Generator().manual_seed(i)
+        return {'depth': torch.rand(1, 4, 8, generator=g),
+                'label': torch.randint(0, 5, (1, 4, 8), generator=g),
+                'meta': {'lwo': torch.full((3,), float(i))},
+                'path': 'frame_%d' % i}
+
+
+def assert_batches_equal(a, b):
+    assert a.keys() == b.keys()
+    for k in a:
+        if isinstance(a[k], dict):
+            assert_batches_equal(a[k], b[k])
+        elif torch.is_tensor(a[k]):
+            assert a[k].dtype == b[k].dtype and torch.equal(a[k], b[k])
+        else:
+            assert a[k] == b[k]
+
+
+def test_prefetched_batches_match_loader():
+    loader = DataLoader(ToyDataset(), batch_size=3, shuffle=False)
+    prefetcher = DevicePrefetcher(loader, 'cpu')
+    assert len(prefetcher) == len(loader)
+    batches = list(prefetcher)
+    assert len(batches) == len(loader)
+    for prefetched, plain in zip(batches, loader):
+        assert_batches_equal(prefetched, plain)
+
+
+def test_pack_unpack_round_trip():
+    batch = ToyDataset()[0]
+    tensors = [(('depth',), batch['depth']), (('label',), batch['label']), (('meta', 'lwo'), batch['meta']['lwo'])]
+    buffers, layout = pack(tensors)
+    assert len(buffers) == 2
+    out = unpack(buffers, layout)
+    for path, t in tensors:
+        assert torch.equal(out[path], t)
+
+
+def test_to_device_cpu_keeps_tensors():
+    batch = ToyDataset()[1]
+    out = to_device(batch, 'cpu')
+    assert out['depth'] is batch['depth']
+    assert out['meta']['lwo'] is batch['meta']['lwo']
+
+
+def test_normalize_device():
+    assert normalize_device('cpu') == torch.device('cpu')
+    if torch.cuda.is_available():
+        assert normalize_device('cuda') == torch.device('cuda', torch.cuda.current_device())
+        assert normalize_device('cuda:0') == torch.device('cuda:0')
@@ -12,6 +12,7 @@ import torch
 import tqdm
 import os
 from util.lidar import LiDAR
+from util.transfer import DevicePrefetcher
 from util import *
 from collections import defaultdict
 import shutil
@@ -139,6 +140,8 @@ def main(runner_cfg_path=None):
     parser.add_argument('--on_input', action='store_true', help='unsupervised metrics will be calculated on dataset A')
     parser.add_argument('--on_real', action='store_true', help='if input is real data')
     parser.add_argument('--no_inv', action='store_true', help='use it to calc unsupervised metrics on input inv, in case modality_B does not contain inv')
+    parser.add_argument('--autotune-loader', action='store_true', help='benchmark DataLoader worker/prefetch settings before training')
+    parser.add_argument('--amp', action='store_true', help='mixed precision training (bfloat16 on CPU, float16 with loss scaling on GPU)')
     cl_args = parser.parse_args()
     torch.cuda.set_device(f'cuda:{cl_args.gpu}')
     if runner_cfg_path is not None:
@@ -157,6 +160,12 @@ def main(runner_cfg_path=None):
     ## test whole code fast
     if cl_args.fast_test and opt.training.isTrain:
         modify_opt_for_fast_test(opt.training)
+    if cl_args.autotune_loader:
+        if not hasattr(opt, 'loader'):
+            opt.loader = make_class_from_dict({})
+        opt.loader.autotune = True
+    if cl_args.amp:
+        opt.training.amp = True
 
     if not opt.training.isTrain:
         opt.training.n_epochs = 1
@@ -232,11 +241,17 @@ def main(runner_cfg_path=None):
         e_steps = 0                  # the number of training iterations in current epoch, reset to 0 every epoch
         # Train loop
         model.train(True)
-        train_dl_iter = iter(train_dl)
+        if hasattr(train_dataset, 'set_epoch'):
+            train_dataset.set_epoch(epoch)
+        # the copy of batch i+1 to the device overlaps step i
+        train_dl_iter = iter(DevicePrefetcher(train_dl, model.device))
         n_train_batch = 2 if cl_args.fast_test else len(train_dl)
         train_tq = tqdm.tqdm(total=n_train_batch, desc='Iter', position=3)
         for i in range(n_train_batch):  # inner loop within one epoch
-            data = next(train_dl_iter)
+            # streaming datasets may end a few batches early when sharded across workers
+            data = next(train_dl_iter, None)
+            if data is None:
+                break
 
             g_steps += 1
             e_steps += 1
@@ -260,7 +275,7 @@ def main(runner_cfg_path=None):
                 train_tq.write('saving the latest model (epoch %d, total_iters %d)' % (epoch, g_steps))
                 model.save_networks('latest')
             train_tq.update(1)
-        val_dl_iter = iter(val_dl)
+        val_dl_iter = iter(DevicePrefetcher(val_dl, model.device))
         n_val_batch = 2 if cl_args.fast_test else  len(val_dl)
         ##### validation
         val_losses = defaultdict(list)
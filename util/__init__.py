@@ -10,9 +10,13 @@ import torch.nn.functional as F
 import matplotlib
 import matplotlib.cm as cm
 import os
+from util.label_mapper import LabelMapper
+from util.transfer import to_device
 # from util.geometry import estimate_surface_normal
 
 m2ch = {'label':1, 'rgb':3, 'reflectance':1, 'mask':1, 'inv':1, 'depth':1}
+# entries of a dataset sample read by fetch_reals
+fetch_keys = ('mask', 'depth', 'points', 'lwo', 'reflectance', 'rgb', 'label', 'path')
 
 
 def make_class_from_dict(opt):
@@ -92,6 +96,8 @@ def cat_modality(data_dict, modality):
     return out
     
 def fetch_reals(data, lidar, device, norm_label=False):
+    # one packed copy of the raw batch, a no-op when it was prefetched to device
+    data = to_device({k: data[k] for k in fetch_keys if k in data}, device)
     mask = data["mask"].float()
     inv = lidar.invert_depth(data["depth"])
     inv = sigmoid_to_tanh(inv)  # [-1,1]
@@ -106,8 +112,6 @@ def fetch_reals(data, lidar, device, norm_label=False):
         batch['rgb'] = sigmoid_to_tanh(data['rgb'])
     if 'label' in data: 
         batch['label'] = sigmoid_to_tanh(data['label']) if norm_label else data['label']
-    for k , v in batch.items():
-        batch[k] = v.to(device)
     batch['path'] = data['path']
     return batch
 
@@ -223,10 +227,10 @@ def postprocess(synth, lidar, tol=1e-8, data_maps=None, dataset_name='kitti', no
                 if norm_label and key != 'synth_label':
                     value = tanh_to_sigmoid(value)
                     value = torch.round(value * (10.0 if  dataset_name == 'semanticPOSS' else 19.0))
-                label_tensor = _map(_map(value.squeeze(dim=1).long(), data_maps.learning_map_inv), data_maps.color_map)
+                label_tensor = LabelMapper.get(data_maps.learning_map_inv, data_maps.color_map)(value.squeeze(dim=1).long())
                 out[key] = torch.flip(label_tensor.permute(0, 3, 1, 2), dims=(1,))
             elif dataset_name == 'nuscene':
-                label_tensor = _map(_map(_map(value.squeeze().long(), labels_mapping), data_maps.learning_map_inv), data_maps.color_map)
+                label_tensor = LabelMapper.get(labels_mapping, data_maps.learning_map_inv, data_maps.color_map)(value.squeeze().long())
                 out[key] = torch.flip(label_tensor.permute(0, 3, 1, 2), dims=(1,))
         elif 'rgb' in key:
             out[key] = tanh_to_sigmoid(value).clamp_(0, 1) * 255.0
@@ -292,28 +296,4 @@ def masked_loss(img_ref, img_gen, mask, distance="l1"):
 
 
 def _map(label, mapdict):
-    # put label from original values to xentropy
-    # or vice-versa, depending on dictionary values
-    # make learning map a lookup table
-    maxkey = 0
-    for key, data in mapdict.items():
-        if isinstance(data, list):
-            nel = len(data)
-        else:
-            nel = 1
-        if key > maxkey:
-            maxkey = key
-    # +100 hack making lut bigger just in case there are unknown labels
-    if nel > 1:
-        lut = np.zeros((maxkey + 100, nel), dtype=np.int32)
-    else:
-        lut = np.zeros((maxkey + 100), dtype=np.int32)
-    for key, data in mapdict.items():
-        try:
-            lut[key] = data
-        except IndexError:
-            print("Wrong key ", key)
-    # do the mapping
-    if torch.is_tensor(label):
-        lut = torch.from_numpy(lut).to(label.get_device()).long()
-    return lut[label]
\ No newline at end of file
+    return LabelMapper.get(mapdict)(label)
\ No newline at end of file
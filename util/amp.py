@@ -0,0 +1,43 @@
+import functools
+
+import torch
+from packaging import version
+
+# torch < 2.4 has no device argument to is_autocast_enabled, it reports CUDA only
+_per_device_query = version.parse(torch.__version__.split('+')[0]) >= version.parse('2.4')
+
+
+def autocast_enabled():
+    if _per_device_query:
+        return torch.is_autocast_enabled('cpu') or torch.is_autocast_enabled('cuda')
+    return torch.is_autocast_enabled() or torch.is_autocast_cpu_enabled()
+
+
+def grad_scaler():
+    # torch.amp.GradScaler only exists from torch 2.3
+    if hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda')
+    return torch.cuda.amp.GradScaler()
+
+
+def autocast_off():
+    # autocast is tracked per device type, disable it for both
+    return torch.autocast('cpu', enabled=False), torch.autocast('cuda', enabled=False)
+
+
+def full_precision(fn):
+    """Runs fn outside autocast with its floating point tensor arguments in float32.
+
+    For the numerically sensitive parts (depth inversion, Gumbel noise, loss
+    reductions) of models trained in mixed precision.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not autocast_enabled():
+            return fn(*args, **kwargs)
+        args = [a.float() if torch.is_tensor(a) and a.is_floating_point() else a for a in args]
+        kwargs = {k: v.float() if torch.is_tensor(v) and v.is_floating_point() else v for k, v in kwargs.items()}
+        cpu_off, cuda_off = autocast_off()
+        with cpu_off, cuda_off:
+            return fn(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,71 @@
+import copy
+
+import numpy as np
+import torch
+
+
+def build_lut(mapdict):
+    # put label from original values to xentropy
+    # or vice-versa, depending on dictionary values
+    # make learning map a lookup table
+    maxkey = 0
+    for key, data in mapdict.items():
+        if isinstance(data, list):
+            nel = len(data)
+        else:
+            nel = 1
+        if key > maxkey:
+            maxkey = key
+    # +100 hack making lut bigger just in case there are unknown labels
+    if nel > 1:
+        lut = np.zeros((maxkey + 100, nel), dtype=np.int32)
+    else:
+        lut = np.zeros((maxkey + 100), dtype=np.int32)
+    for key, data in mapdict.items():
+        try:
+            lut[key] = data
+        except IndexError:
+            print("Wrong key ", key)
+    return lut
+
+
+class LabelMapper():
+    """A chain of label dicts compiled into one lookup table.
+
+    LabelMapper.get(learning_map_inv, color_map)(label) is the same as
+    _map(_map(label, learning_map_inv), color_map) but indexes a single
+    composed LUT. Mappers are memoized per chain of dicts, and the torch
+    LUT is kept resident on every device it has been used on. A dict edited
+    in place after its mapper was built gets a new LUT.
+    """
+
+    # id(dicts) -> (dicts, copies of the dicts, mapper); the dicts are kept
+    # alive so ids stay unique, the copies tell when one was edited in place
+    _cache = {}
+
+    def __init__(self, *mapdicts):
+        lut = build_lut(mapdicts[0])
+        for mapdict in mapdicts[1:]:
+            lut = build_lut(mapdict)[lut]
+        self.lut = lut
+        self._device_luts = {}
+
+    @classmethod
+    def get(cls, *mapdicts):
+        key = tuple(id(m) for m in mapdicts)
+        entry = cls._cache.get(key)
+        # dict equality runs in C, far cheaper than rebuilding or hashing the contents
+        if entry is None or any(m != c for m, c in zip(mapdicts, entry[1])):
+            entry = cls._cache[key] = (mapdicts, copy.deepcopy(mapdicts), cls(*mapdicts))
+        return entry[2]
+
+    def torch_lut(self, device):
+        lut = self._device_luts.get(device)
+        if lut is None:
+            lut = self._device_luts[device] = torch.from_numpy(self.lut).to(device).long()
+        return lut
+
+    def __call__(self, label):
+        if torch.is_tensor(label):
+            return self.torch_lut(label.device)[label]
+        return self.lut[label]
@@ -8,6 +8,8 @@ import numba
 
 import numpy as np
 
+from util.amp import full_precision
+
 
 
 
@@ -49,12 +51,25 @@ labelmap = {
 }
 
 # @numba.jit
-def scatter(arrary, index, value):
+def scatter_loop(arrary, index, value):
+    # reference implementation, see benchmark_lidar.py
     for (h, w), v in zip(index, value):
         arrary[h, w] = v
     return arrary
 
 
+def scatter(arrary, index, value):
+    # same result as scatter_loop: when several points fall into one pixel the
+    # last one wins, which is the nearest one as projection() sorts by -depth
+    H, W = arrary.shape[:2]
+    flat = index[:, 0].astype(np.intp) * W + index[:, 1]
+    last = np.full(H * W, -1, dtype=np.intp)
+    np.maximum.at(last, flat, np.arange(len(flat)))
+    last = last[last >= 0]
+    arrary.reshape(H * W, *arrary.shape[2:])[flat[last]] = value[last]
+    return arrary
+
+
 def projection(source, grid, order, H, W):
     assert source.ndim == 2, source.ndim
     C = source.shape[1]
@@ -87,19 +102,12 @@ def point_cloud_to_xyz_image(points, H=64, W=2048, fov_up=3.0, fov_down=-25.0, i
     else:
         # the i-th quadrant
         # suppose the points are ordered counterclockwise
-        quads = np.zeros_like(x)
-        quads[(x >= 0) & (y >= 0)] = 0  # 1st
-        quads[(x < 0) & (y >= 0)] = 1  # 2nd
-        quads[(x < 0) & (y < 0)] = 2  # 3rd
-        quads[(x >= 0) & (y < 0)] = 3  # 4th
+        quads = np.where(y >= 0, np.where(x >= 0, 0, 1), np.where(x < 0, 2, 3))  # 1st..4th
         diff = np.roll(quads, 1) - quads
-        (start_inds,) = np.where(diff == 3)  # number of lines
-        inds = list(start_inds) + [len(quads)]  # add the last index
-        line_idx = 63  # ...0
-        grid_h = np.zeros_like(x)
-        for i in reversed(range(len(start_inds))):
-            grid_h[inds[i] : inds[i + 1]] = line_idx
-            line_idx -= 1
+        # a new line starts where the quadrant wraps from the 4th to the 1st,
+        # the last line is 63 and the points before the first wrap stay on 0
+        line_count = np.cumsum(diff == 3)
+        grid_h = np.where(line_count > 0, 63 - line_count[-1] + line_count, 0).astype(x.dtype)
         
     # horizontal grid
     yaw = -np.arctan2(y, x)  # [-pi,pi]
@@ -112,6 +120,86 @@ def point_cloud_to_xyz_image(points, H=64, W=2048, fov_up=3.0, fov_down=-25.0, i
     proj = projection(points, grid, order, H, W)
     return proj, grid
 
+def pad_points(point_clouds):
+    """List of (N_i, C) point clouds -> zero padded (B, N, C) tensor and lengths (B,)."""
+    point_clouds = [torch.as_tensor(p) for p in point_clouds]
+    lengths = torch.tensor([len(p) for p in point_clouds], dtype=torch.long)
+    return nn.utils.rnn.pad_sequence(point_clouds, batch_first=True), lengths
+
+
+def batch_point_cloud_to_range_image(points, lengths=None, H=64, W=2048, fov_up=3.0, fov_down=-25.0, limited_view=False):
+    """Batched torch counterpart of point_cloud_to_xyz_image (is_sorted=False).
+
+    points is a (B, N, C) padded batch whose first channels are x, y, z
+    (then e.g. reflectance), or a list of (N_i, C) scans. lengths (B,) gives
+    the number of valid points of each scan. Runs on the device of points.
+    When several points fall into one pixel the nearest one is kept.
+
+    Returns a dict of (B, C, H, W) `proj` with `points` (xyz) and
+    `reflectance` views of it, (B, 1, H, W) `depth` and (B, H, W) `proj_idx`,
+    the index of the point in its scan or -1 for empty pixels.
+    """
+    if isinstance(points, (list, tuple)):
+        points, lengths = pad_points(points)
+    B, N, C = points.shape
+    device = points.device
+    xyz = points[..., :3]
+    depth = torch.linalg.norm(xyz, ord=2, dim=-1)
+    valid = depth > 0
+    if lengths is not None:
+        valid &= torch.arange(N, device=device)[None] < lengths.to(device)[:, None]
+
+    fov_up = fov_up / 180.0 * np.pi
+    fov_down = fov_down / 180.0 * np.pi
+    fov = abs(fov_down) + abs(fov_up)
+    pitch = torch.asin(xyz[..., 2] / depth)
+    grid_h = 1.0 - (pitch + abs(fov_down)) / fov
+    grid_h = torch.clamp(torch.round(grid_h * H), 0, H - 1)
+    yaw = -torch.atan2(xyz[..., 1], xyz[..., 0])
+    grid_w = (yaw / (np.pi / 4) + 1) / 2 if limited_view else (yaw / np.pi + 1) / 2
+    grid_w = torch.clamp(torch.round(grid_w * W), 0, W - 1)
+
+    # flat pixel of every valid point over the whole batch
+    batch_idx = torch.arange(B, device=device)[:, None].expand(B, N)[valid]
+    point_idx = torch.arange(N, device=device)[None].expand(B, N)[valid]
+    pixel = (batch_idx * H + grid_h[valid].long()) * W + grid_w[valid].long()
+    depth_v = depth[valid]
+    # nearest depth per pixel, then the last of the points at that depth
+    min_depth = torch.full((B * H * W,), float('inf'), dtype=depth.dtype, device=device)
+    min_depth.scatter_reduce_(0, pixel, depth_v, reduce='amin')
+    nearest = depth_v == min_depth[pixel]
+    proj_idx = torch.full((B * H * W,), -1, dtype=torch.long, device=device)
+    proj_idx.scatter_reduce_(0, pixel[nearest], point_idx[nearest], reduce='amax')
+
+    hit = proj_idx >= 0
+    flat_points = points.reshape(B * N, C)
+    proj = points.new_zeros(B * H * W, C)
+    proj[hit] = flat_points[torch.div(hit.nonzero()[:, 0], H * W, rounding_mode='floor') * N + proj_idx[hit]]
+    proj = proj.reshape(B, H, W, C).permute(0, 3, 1, 2)
+    out = {
+        'proj': proj,
+        'points': proj[:, :3],
+        'depth': torch.linalg.norm(proj[:, :3], ord=2, dim=1, keepdim=True),
+        'proj_idx': proj_idx.reshape(B, H, W),
+    }
+    if C > 3:
+        out['reflectance'] = proj[:, [3]]
+    return out
+
+
+# angle maps and the tensors derived from them, shared by every Coordinate with
+# the same grid_key: {(grid_key, device): {name: tensor}}
+_GRID_CACHE = {}
+
+
+def clear_grid_cache():
+    _GRID_CACHE.clear()
+
+
+def _grid(name):
+    return property(lambda self: self.grids()[name])
+
+
 class Coordinate(nn.Module):
     def __init__(self, min_depth, max_depth, shape, drop_const=0) -> None:
         super().__init__()
@@ -119,7 +207,63 @@ class Coordinate(nn.Module):
         self.max_depth = max_depth
         self.H, self.W = shape
         self.drop_const = drop_const
-        self.register_buffer("angle", self.init_coordmap(self.H, self.W))
+        # empty, only follows .to()/.cuda() to tell which device copy of the grids to use
+        self.register_buffer("device_probe", torch.empty(0), persistent=False)
+        self._grids = {}
+        self._grid_key = self.grid_key()
+        self.grids()
+
+    # read-only, shared between instances: never modify in place
+    angle = _grid("angle")
+    # unit ray direction of every pixel
+    rays = _grid("rays")
+    # mean elevation of every row and azimuth of every column, for the
+    # candidate pixels of points_to_depth
+    row_centers = _grid("row_centers")
+    row_index = _grid("row_index")
+    col_centers = _grid("col_centers")
+    col_index = _grid("col_index")
+
+    def grid_key(self):
+        """Key of the angle map in the shared cache, None keeps the grids private."""
+        return None
+
+    def build_grids(self):
+        angle = self.init_coordmap(self.H, self.W)
+        row_centers, row_index = self.bin_centers(angle[0, 0].mean(dim=1))
+        col_centers, col_index = self.bin_centers(angle[0, 1].mean(dim=0), period=2 * np.pi)
+        return {
+            "angle": angle,
+            "rays": self.init_rays(angle),
+            "row_centers": row_centers,
+            "row_index": row_index,
+            "col_centers": col_centers,
+            "col_index": col_index,
+        }
+
+    def grids(self):
+        """Grids on the device of the module, built once per key and copied once per device."""
+        device = self.device_probe.device
+        key = self._grid_key
+        cache = self._grids if key is None else _GRID_CACHE
+        grids = cache.get((key, device))
+        if grids is None:
+            cpu = torch.device("cpu")
+            if (key, cpu) not in cache:
+                cache[(key, cpu)] = {k: v.cpu() for k, v in self.build_grids().items()}
+            grids = cache[(key, device)] = {k: v.to(device) for k, v in cache[(key, cpu)].items()}
+        return grids
+
+    @staticmethod
+    def init_rays(angle):
+        pitch, yaw = angle[:, [0]], angle[:, [1]]
+        return torch.cat((torch.cos(pitch) * torch.cos(yaw), torch.cos(pitch) * torch.sin(yaw), torch.sin(pitch)), dim=1)
+
+    def rays_like(self, x):
+        # crop to smaller inputs, like pol_to_xyz did with the angle grid
+        if self.rays.shape[2] != x.shape[2] or self.rays.shape[3] != x.shape[3]:
+            return self.rays[:, :, :x.shape[2], :x.shape[3]]
+        return self.rays
 
     def init_coordmap(self, H, W):
         raise NotImplementedError
@@ -132,6 +276,7 @@ class Coordinate(nn.Module):
     def denormalize_minmax(tensor, vmin: float, vmax: float):
         return tensor * (vmax - vmin) + vmin
 
+    @full_precision
     def invert_depth(self, norm_depth):
         # depth to inverse depth
         depth = self.denormalize_minmax(norm_depth, self.min_depth, self.max_depth)
@@ -139,12 +284,11 @@ class Coordinate(nn.Module):
         norm_disp = self.normalize_minmax(disp, 1 / self.max_depth, 1 / self.min_depth)
         return norm_disp
 
+    @full_precision
     def revert_depth(self, norm_disp, norm=True):
         # inverse depth to depth
-        disp = self.denormalize_minmax(
-            norm_disp, 1 / self.max_depth, 1 / self.min_depth
-        )
-        depth = 1 / disp
+        disp = norm_disp.mul(1 / self.min_depth - 1 / self.max_depth).add_(1 / self.max_depth)
+        depth = disp.reciprocal()
         if norm:
             return self.normalize_minmax(depth, self.min_depth, self.max_depth)
         else:
@@ -152,66 +296,120 @@ class Coordinate(nn.Module):
 
     def pol_to_xyz(self, polar):
         assert polar.dim() == 4 # B, C, H, W
-        grid_cos = torch.cos(self.angle)
-        grid_sin = torch.sin(self.angle)
-        if grid_cos.shape[2] != polar.shape[2] or grid_cos.shape[3] != polar.shape[3]:
-            grid_cos = grid_cos[:, :, :polar.shape[2], :polar.shape[3]]
-            grid_sin = grid_sin[:, :, :polar.shape[2], :polar.shape[3]]
-        grid_x = polar * grid_cos[:, [0]] * grid_cos[:, [1]]
-        grid_y = polar * grid_cos[:, [0]] * grid_sin[:, [1]]
-        grid_z = polar * grid_sin[:, [0]]
-        return torch.cat((grid_x, grid_y, grid_z), dim=1)
+        return polar * self.rays_like(polar)
 
     def xyz_to_pol(self, xyz):
         return torch.norm(xyz, p=2, dim=1, keepdim=True)
 
+    @full_precision
     def inv_to_xyz(self, inv_depth, tol=1e-8): # inv_depth [0, 1]
+        # revert_depth, denormalisation and division by max_depth folded into
+        # depth / max_depth = 1 / (inv_depth * (max_depth / min_depth - 1) + 1)
         valid = torch.abs(inv_depth - self.drop_const) > tol
-        depth = self.revert_depth(inv_depth)  # [0,1] depth
-        depth = depth * (self.max_depth - self.min_depth) + self.min_depth
-        depth /= self.max_depth
-        depth *= valid
-        points = self.pol_to_xyz(depth)
-        return points
-
-    def points_to_depth(self, xyz, drop_value=1, tol=1e-8, tau=2):
+        depth = inv_depth.mul(self.max_depth / self.min_depth - 1).add_(1).reciprocal()
+        return torch.where(valid, depth, 0) * self.rays_like(inv_depth)
+
+    @full_precision
+    def points_to_depth(self, xyz, drop_value=1, tol=1e-8, tau=2, mode="nearest"):
+        """(B, N, 3) points in unit space -> (B, 1, H, W) normalised depth and valid mask.
+
+        Every point is binned in O(N): the rows and columns with the nearest
+        mean elevation and azimuth, and those on both sides of them, give a
+        3x3 window of candidate pixels, and the point goes to the candidate whose own angles
+        in the angle grid are the nearest, so rows and columns need not be
+        aligned. "nearest" keeps the nearest point of every pixel, "bilinear"
+        splats every point onto its pixel and the neighbouring pixels towards
+        it, weighted by exp(-tau * depth). Zero padded points are ignored.
+        Points produced by pol_to_xyz land back on their own pixel only, in
+        both modes.
+        """
         assert xyz.ndim == 3
-        device = xyz.device
-
-        x = xyz[..., [0]]
-        y = xyz[..., [1]]
-        z = xyz[..., [2]]
-        r = torch.norm(xyz[..., :2], p=2, dim=2, keepdim=True)
-        depth_1d = torch.norm(xyz, p=2, dim=2, keepdim=True)
-        weight = 1.0 / torch.exp(tau * depth_1d)
-        depth_1d = depth_1d * self.max_depth
-        weight *= ((depth_1d > self.min_depth) & (depth_1d < self.max_depth)).detach()
-
-        angle_u = torch.atan2(z, r)  # elevation
-        angle_v = torch.atan2(y, x)  # azimuth
-        angle_uv = torch.cat([angle_u, angle_v], dim=2)
-        angle_uv = einops.rearrange(angle_uv, "b n c -> b n 1 c")
-        angle_uv_ref = einops.rearrange(self.angle, "b c h w -> b 1 (h w) c")
-
-        _, ids = torch.norm(angle_uv - angle_uv_ref, p=2, dim=3).min(dim=2)
-        id_to_uv = einops.rearrange(
-            torch.stack(
-                torch.meshgrid(
-                    torch.arange(self.H, device=device),
-                    torch.arange(self.W, device=device),
-                ),
-                dim=-1,
-            ),
-            "h w c -> (h w) c",
-        )
-        uv = F.embedding(ids, id_to_uv).float()
-        depth_2d = render.bilinear_rasterizer(uv, weight * depth_1d, (self.H, self.W))
-        depth_2d /= render.bilinear_rasterizer(uv, weight, (self.H, self.W)) + 1e-8
-        valid = depth_2d != 0
-        depth_2d = self.minmax_norm(depth_2d, self.min_depth, self.max_depth)
-        depth_2d[~valid] = drop_value
+        assert mode in ("nearest", "bilinear"), mode
+        B, N, _ = xyz.shape
+        H, W = self.angle.shape[2:]
+        pitch_grid, yaw_grid = self.angle[0, 0], self.angle[0, 1]
+        r = torch.norm(xyz[..., :2], p=2, dim=2)
+        depth_1d = torch.norm(xyz, p=2, dim=2) * self.max_depth
+        in_range = (depth_1d > self.min_depth) & (depth_1d < self.max_depth)
+        pitch = torch.atan2(xyz[..., 2], r)  # elevation
+        yaw = torch.atan2(xyz[..., 1], xyz[..., 0])  # azimuth
+        h0, w0 = self.nearest_pixel(pitch, yaw)
+        batch = torch.arange(B, device=xyz.device)[:, None] * (H * W)
+
+        if mode == "nearest":
+            pixel = (batch + h0 * W + w0)[in_range]
+            depth_2d = xyz.new_full((B * H * W,), float("inf"))
+            depth_2d.scatter_reduce_(0, pixel, depth_1d[in_range], reduce="amin")
+            valid = torch.isfinite(depth_2d)
+            depth_2d = torch.where(valid, depth_2d, 0)
+        else:
+            h1, th = self.neighbour(pitch, pitch_grid, h0, w0, dim=0)
+            w1, tw = self.neighbour(yaw, yaw_grid, h0, w0, dim=1, period=2 * np.pi)
+            weight = torch.exp(-tau * depth_1d / self.max_depth) * in_range.detach()
+            pixel = torch.cat([batch + h0 * W + w0, batch + h0 * W + w1, batch + h1 * W + w0, batch + h1 * W + w1], dim=1)
+            weight = torch.cat([(1 - th) * (1 - tw), (1 - th) * tw, th * (1 - tw), th * tw], dim=1) * weight.repeat(1, 4)
+            depth_2d = xyz.new_zeros(B * H * W).index_add_(0, pixel.flatten(), (weight * depth_1d.repeat(1, 4)).flatten())
+            norm = xyz.new_zeros(B * H * W).index_add_(0, pixel.flatten(), weight.flatten())
+            valid = norm > tol
+            depth_2d = torch.where(valid, depth_2d / norm.clamp(min=tol), 0)
+
+        depth_2d = self.normalize_minmax(depth_2d, self.min_depth, self.max_depth)
+        depth_2d = torch.where(valid, depth_2d, drop_value)
+        return depth_2d.reshape(B, 1, H, W), valid.reshape(B, 1, H, W)
+
+    def nearest_pixel(self, pitch, yaw):
+        # the pixel of the candidate window with the nearest elevation and azimuth
+        W = self.angle.shape[3]
+        rows = self.bin_window(pitch, self.row_centers, self.row_index)
+        cols = self.bin_window(yaw, self.col_centers, self.col_index)
+        pixel = (rows[..., :, None] * W + cols[..., None, :]).flatten(-2)
+        d_pitch = self.angle[0, 0].flatten()[pixel] - pitch[..., None]
+        d_yaw = self.wrap(self.angle[0, 1].flatten()[pixel] - yaw[..., None], 2 * np.pi)
+        pixel = pixel.gather(-1, (d_pitch * d_pitch + d_yaw * d_yaw).argmin(dim=-1, keepdim=True))[..., 0]
+        return pixel // W, pixel % W
+
+    @staticmethod
+    def bin_centers(centers, period=None):
+        # ascending bin centers and the row/column of each, padded with the
+        # wrapped neighbours when the axis is periodic
+        centers, index = torch.sort(centers)
+        if period is not None:
+            centers = torch.cat([centers[-1:] - period, centers, centers[:1] + period])
+            index = torch.cat([index[-1:], index, index[:1]])
+        return centers.contiguous(), index
 
-        return depth_2d, valid
+    @staticmethod
+    def bin_window(values, centers, index):
+        # rows/columns of the nearest bin center of every value and of the centers on both sides of it
+        j = torch.searchsorted(centers, values.contiguous()).clamp(1, len(centers) - 1)
+        j = torch.where(values - centers[j - 1] < centers[j] - values, j - 1, j)
+        offsets = torch.arange(-1, 2, device=values.device)
+        return index[(j[..., None] + offsets).clamp(0, len(centers) - 1)]
+
+    @staticmethod
+    def wrap(angle, period):
+        return torch.remainder(angle + period / 2, period) - period / 2
+
+    def neighbour(self, values, grid, h, w, dim, period=None):
+        """Pixel next to (h, w) along dim on the side of values, and the fractional position towards it."""
+        size = grid.shape[dim]
+        idx = h if dim == 0 else w
+        if period is None:
+            prev, nxt = (idx - 1).clamp(min=0), (idx + 1).clamp(max=size - 1)
+        else:
+            prev, nxt = (idx - 1) % size, (idx + 1) % size
+        at = lambda i: grid[i, w] if dim == 0 else grid[h, i]
+        center = at(idx)
+        diff, d_prev, d_next = values - center, at(prev) - center, at(nxt) - center
+        if period is not None:
+            diff, d_prev, d_next = self.wrap(diff, period), self.wrap(d_prev, period), self.wrap(d_next, period)
+        towards_next = diff * d_next > 0
+        other = torch.where(towards_next, nxt, prev)
+        step = torch.where(towards_next, d_next, d_prev)
+        t = torch.where(step != 0, diff / torch.where(step != 0, step, 1), 0).clamp(0, 1)
+        # points on a pixel (up to rounding) stay on that pixel only
+        t = torch.where((t < 1e-3) | (diff.abs() < 1e-5), 0, torch.where(t > 1 - 1e-3, 1, t))
+        return other, t
 
 
 class LiDAR(Coordinate):
@@ -235,6 +433,11 @@ class LiDAR(Coordinate):
             shape=(num_ring, num_points)
         )
 
+    def grid_key(self):
+        # the LiDARs of one run (and of the same dataset) read the same angles.pt
+        angle_file = os.path.abspath(self.angle_file)
+        return (angle_file, os.stat(angle_file).st_mtime_ns, self.height, self.width)
+
     def init_coordmap(self, H, W):
         angle = torch.load(self.angle_file)[None]
         # fov_up = self.fov_up / 180.0 * np.pi     
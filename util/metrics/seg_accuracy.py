@@ -1,8 +1,10 @@
 import numpy as np
+import torch
 from rangenet.tasks.semantic.modules.ioueval import iouEval
 import torchvision.transforms.functional as TF
 from util import _map
 
+@torch.inference_mode()
 def compute_seg_accuracy(seg_model, synth_data, gt_labels, ignore=[], label_map=None, fetched_mask=None):
     # H , W = 64, 2048
     # synth_data = TF.resize(synth_data, (H, W), TF.InterpolationMode.NEAREST)
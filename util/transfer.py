@@ -0,0 +1,145 @@
+import torch
+
+
+def normalize_device(device):
+    """torch.device with its index filled in, so that 'cuda' compares equal to the tensors on cuda:N."""
+    device = torch.device(device)
+    if device.type == 'cuda' and device.index is None:
+        device = torch.device('cuda', torch.cuda.current_device())
+    return device
+
+
+def flatten_tensors(data, prefix=()):
+    """(key path, tensor) of every tensor in a possibly nested batch dict."""
+    for k, v in data.items():
+        if isinstance(v, dict):
+            yield from flatten_tensors(v, prefix + (k,))
+        elif torch.is_tensor(v):
+            yield prefix + (k,), v
+
+
+def replace_tensors(data, tensors, prefix=()):
+    # copy of data with the tensors at the given key paths replaced, other values kept as is
+    out = {}
+    for k, v in data.items():
+        path = prefix + (k,)
+        if isinstance(v, dict):
+            out[k] = replace_tensors(v, tensors, path)
+        else:
+            out[k] = tensors.get(path, v)
+    return out
+
+
+def pack(tensors, staging=None):
+    """Packs tensors into one flat buffer per dtype.
+
+    staging maps dtype to a reusable flat buffer, grown (pinned when CUDA is
+    available) when too small. Returns the packed buffers and the layout
+    needed by `unpack`.
+    """
+    staging = {} if staging is None else staging
+    sizes = {}
+    for _, t in tensors:
+        sizes[t.dtype] = sizes.get(t.dtype, 0) + t.numel()
+    for dtype, size in sizes.items():
+        if dtype not in staging or staging[dtype].numel() < size:
+            staging[dtype] = torch.empty(size, dtype=dtype, pin_memory=torch.cuda.is_available())
+    offsets = dict.fromkeys(sizes, 0)
+    layout = []
+    for path, t in tensors:
+        start = offsets[t.dtype]
+        staging[t.dtype][start:start + t.numel()].view(t.shape).copy_(t)
+        offsets[t.dtype] = start + t.numel()
+        layout.append((path, t.dtype, start, t.shape))
+    return {dtype: staging[dtype][:size] for dtype, size in sizes.items()}, layout
+
+
+def unpack(buffers, layout):
+    return {path: buffers[dtype][start:start + shape.numel()].view(shape) for path, dtype, start, shape in layout}
+
+
+class BatchTransfer():
+    """Moves every tensor of a batch dict to device with one copy per dtype.
+
+    The tensors are packed into a pinned staging buffer and copied with a
+    single non-blocking copy on a side stream, so the copy of the next batch
+    overlaps the current step. Two staging buffers are used in turn; a buffer
+    is only refilled once its previous copy is done. On the CPU, tensors are
+    returned as they are.
+    """
+
+    def __init__(self, device, n_buffers=2):
+        self.device = normalize_device(device)
+        self.use_stream = self.device.type == 'cuda' and torch.cuda.is_available()
+        self.stream = torch.cuda.Stream(self.device) if self.use_stream else None
+        self.staging = [{} for _ in range(n_buffers)]
+        self.events = [None] * n_buffers
+        self.slot = 0
+
+    def start(self, data):
+        """Issues the copy of data, `wait` returns it on the device."""
+        tensors = [(path, t) for path, t in flatten_tensors(data) if t.device != self.device]
+        if not tensors:
+            return data, None
+        if self.device.type != 'cuda':
+            return replace_tensors(data, {path: t.to(self.device) for path, t in tensors}), None
+        slot = self.slot
+        self.slot = (slot + 1) % len(self.staging)
+        if self.events[slot] is not None:
+            self.events[slot].synchronize()
+        buffers, layout = pack(tensors, self.staging[slot])
+        stream = self.stream or torch.cuda.current_stream(self.device)
+        with torch.cuda.stream(stream):
+            buffers = {dtype: b.to(self.device, non_blocking=True) for dtype, b in buffers.items()}
+            self.events[slot] = torch.cuda.Event()
+            self.events[slot].record(stream)
+        return replace_tensors(data, unpack(buffers, layout)), buffers
+
+    def wait(self, pending):
+        data, buffers = pending
+        if buffers is not None and self.stream is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(self.stream)
+            for b in buffers.values():
+                # allocated on the side stream, used on the current one
+                b.record_stream(current)
+        return data
+
+    def __call__(self, data):
+        return self.wait(self.start(data))
+
+
+_transfers = {}
+
+
+def to_device(data, device):
+    """Batch dict on device; tensors already there are left untouched."""
+    device = normalize_device(device)
+    if device not in _transfers:
+        _transfers[device] = BatchTransfer(device)
+    return _transfers[device](data)
+
+
+class DevicePrefetcher():
+    """Iterates over loader with every batch already on device.
+
+    The copy of batch N+1 is issued before batch N is handed out, so it runs
+    while step N computes.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.transfer = BatchTransfer(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        it = iter(self.loader)
+        batch = next(it, None)
+        pending = self.transfer.start(batch) if batch is not None else None
+        while pending is not None:
+            data = self.transfer.wait(pending)
+            batch = next(it, None)
+            pending = self.transfer.start(batch) if batch is not None else None
+            yield data